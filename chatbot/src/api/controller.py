@@ -14,10 +14,17 @@ from fastapi.middleware import Middleware
 
 from src.api import repository
 from src.api.models import ChatUpdate, InvokeChatbotRequestBody, InvokeChatbotStreamingResponse, ChatHistoryEntry, \
-    ChatHistoryTurn
-from src.api.util import format_sse, get_ai_act_part_by_id
+    ChatHistoryTurn, SearchOptions, SearchRequestBody, SearchBatchRequestBody, SearchHit, SearchResponse, \
+    SearchBatchResponse
+from src.api.util import format_sse, get_part_by_id, make_snippet
+from src.config import INDEX_WATCH_INTERVAL, CORPORA, DEFAULT_CORPUS, ADAPTIVE_MIN_SCORE, ADAPTIVE_MIN_RATIO, \
+    ADAPTIVE_MAX_GAP, ADAPTIVE_MIN_DOCUMENTS
 from src.core.util import get_title_from_query
 from src.db import init_db
+from src.retriever.cutoff import cut_documents
+from src.retriever.filters import InvalidFilterError
+from src.retriever.search import search_documents, search_documents_many
+from src.retriever.util import warm_up, is_nlp_loaded, get_snapshot, reload_index, watch_index
 
 origins = [
     "http://localhost:5173"
@@ -43,12 +50,119 @@ async def lifespan(fastapi_app: FastAPI):
 
     fastapi_app.state.chat_locks = defaultdict(lambda: asyncio.Lock())
 
+    # Load classla pipeline and search index in the background, so the API starts serving immediately.
+    # Readiness can be checked with the /ready endpoint.
+    Thread(target=warm_up, daemon=True).start()
+
+    # New index builds written by store_embeddings.py are loaded without restarting the API
+    if INDEX_WATCH_INTERVAL > 0:
+        Thread(target=watch_index, args=(INDEX_WATCH_INTERVAL,), daemon=True).start()
+
     yield
 
 
 app = FastAPI(lifespan=lifespan, title="Chatbot API", middleware=middleware)
 
 
+@app.get("/ready")
+async def ready():
+    """Reports whether the NLP model and the search index are loaded."""
+    try:
+        index_loaded = get_snapshot().documents.is_loaded()
+    except (FileNotFoundError, ValueError):
+        # The index is not built yet, or its manifest or files are not valid
+        index_loaded = False
+    status = {
+        "nlp": is_nlp_loaded(),
+        "index": index_loaded,
+    }
+    status["ready"] = all(status.values())
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
+@app.post("/admin/reload-index")
+async def reload_search_index(corpus: str = DEFAULT_CORPUS):
+    """Loads the index build the manifest of the corpus points to, if it is not the one in use, and swaps it in
+    atomically. Corpora that are not loaded are loaded with their current build on first use anyway."""
+    if corpus not in CORPORA:
+        raise HTTPException(status_code=404, detail="Unknown corpus.")
+    try:
+        reloaded = await asyncio.to_thread(reload_index, corpus)
+        return {"corpus": corpus, "version": get_snapshot(corpus).version, "reloaded": reloaded}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reloading index: {str(e)}")
+
+
+def to_search_response(query: str, documents, options: SearchOptions, corpus: str) -> SearchResponse:
+    if options.adaptive:
+        documents = cut_documents(documents, ADAPTIVE_MIN_SCORE.get(options.engine), ADAPTIVE_MIN_RATIO,
+                                  ADAPTIVE_MAX_GAP, ADAPTIVE_MIN_DOCUMENTS)
+    return SearchResponse(
+        query=query,
+        results=[
+            SearchHit(
+                id=document.metadata["id"],
+                parent_id=document.metadata["parent_id"],
+                type=document.metadata["type"],
+                score=document.metadata["similarity_score"],
+                snippet=make_snippet(document.page_content, options.snippet_chars),
+                part=get_part_by_id(document.metadata["parent_id"], corpus) if options.include_parts else None,
+            )
+            for document in documents
+        ],
+        cutoff=documents[0].metadata["cutoff"] if options.adaptive and documents else None,
+    )
+
+
+def get_search_corpus(options: SearchOptions) -> str:
+    corpus = options.corpus or DEFAULT_CORPUS
+    if corpus not in CORPORA:
+        raise HTTPException(status_code=400, detail="Provided invalid corpus.")
+    return corpus
+
+
+def get_search_filters(options: SearchOptions):
+    return options.filters.model_dump(exclude_none=True) if options.filters else None
+
+
+@app.post("/search")
+async def search(body: SearchRequestBody) -> SearchResponse:
+    """Searches the corpus without calling the LLM and returns ids, scores, types and snippets of the found documents.
+
+    Also serves as a degraded mode of the chatbot when the LLM provider is slow or unavailable.
+    """
+    if body.query.strip() == "":
+        raise HTTPException(status_code=400, detail="Query is required.")
+    corpus = get_search_corpus(body)
+    filters = get_search_filters(body)
+    try:
+        documents = await asyncio.to_thread(search_documents, body.query, body.k, body.engine, body.granularity,
+                                            filters, corpus)
+        return to_search_response(body.query, documents, body, corpus)
+    except InvalidFilterError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching: {str(e)}")
+
+
+@app.post("/search/batch")
+async def search_batch(body: SearchBatchRequestBody) -> SearchBatchResponse:
+    """Searches all queries at once, with a single lemmatization pass and similarity product."""
+    if any(query.strip() == "" for query in body.queries):
+        raise HTTPException(status_code=400, detail="Queries must not be empty.")
+    corpus = get_search_corpus(body)
+    filters = get_search_filters(body)
+    try:
+        documents = await asyncio.to_thread(search_documents_many, body.queries, body.k, body.engine,
+                                            body.granularity, filters, corpus) if body.queries else []
+        return SearchBatchResponse(responses=[to_search_response(query, query_documents, body, corpus)
+                                              for query, query_documents in zip(body.queries, documents)])
+    except InvalidFilterError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching: {str(e)}")
+
+
 @app.get("/chats")
 async def get_chats():
     try:
@@ -108,6 +222,8 @@ async def get_chat_history(chat_id: str) -> List[ChatHistoryTurn]:
     try:
         chat_history_adapter = TypeAdapter(ChatHistoryEntry)
         chat_history = repository.get_chat_history_by_id(chat_id)
+        chat = repository.get_chat_by_id(chat_id)
+        corpus = (chat["corpus"] if chat else None) or DEFAULT_CORPUS
 
         human_messages = {}
         ai_messages = []
@@ -130,7 +246,7 @@ async def get_chat_history(chat_id: str) -> List[ChatHistoryTurn]:
                     # If there are relevant parts, fetch their full content
                     for part in validated_ai_entry.relevant_part_texts:
                         part_id = part.get("id", None)
-                        part["full_content"] = get_ai_act_part_by_id(part_id)
+                        part["full_content"] = get_part_by_id(part_id, corpus)
 
                 paired_history.append(ChatHistoryTurn(human=validated_human_entry, ai=validated_ai_entry))
 
@@ -164,12 +280,16 @@ async def invoke_chatbot(body: InvokeChatbotRequestBody):
 
         # If chat_id is not provided, create a new chat
         if not chat_id:
+            corpus = body.corpus or DEFAULT_CORPUS
+            if corpus not in CORPORA:
+                raise HTTPException(status_code=400, detail="Provided invalid corpus.")
             chat_name = get_title_from_query(user_input)
-            chat_id = repository.create_chat(chat_name)
+            chat_id = repository.create_chat(chat_name, corpus)
         else:
             existing_chat = repository.get_chat_by_id(chat_id)
             if not existing_chat:
                 raise HTTPException(status_code=404, detail="Provided invalid chat_id.")
+            corpus = existing_chat["corpus"] or DEFAULT_CORPUS
 
         # Prepare inputs for the chatbot
         inputs = {
@@ -179,7 +299,12 @@ async def invoke_chatbot(body: InvokeChatbotRequestBody):
             "answer": None,
             "top_3": [],
             "relevant_part_texts": [],
-            "valid_rag_answer": None
+            "valid_rag_answer": None,
+            "corpus": corpus,
+            "speculative_query": None,
+            "speculative_docs": None,
+            "retrieved_docs": None,
+            "cached_answer": None
         }
 
         config = {"configurable": {"thread_id": chat_id}}
@@ -233,6 +358,10 @@ async def invoke_chatbot(body: InvokeChatbotRequestBody):
                                 if isinstance(msg, AIMessageChunk):
                                     answer_to_stream.append(msg.content)
 
+                    # Answers replayed from the answer cache are not generated, so they are streamed whole
+                    if chatbot_response.get("cached_answer") is not None:
+                        rag_answer_to_stream = [chatbot_response["answer"]]
+
                     # Then stream the answer
                     for chunk in (rag_answer_to_stream if (
                             chatbot_response["valid_rag_answer"] == "Valid") else answer_to_stream):
@@ -249,7 +378,7 @@ async def invoke_chatbot(body: InvokeChatbotRequestBody):
 
                     if len(getattr(validated_ai_entry, "relevant_part_texts", [])) > 0:
                         validated_ai_entry.relevant_part_texts = [
-                            {**part.__dict__, "full_content": get_ai_act_part_by_id(getattr(part, "id", None))}
+                            {**part.__dict__, "full_content": get_part_by_id(getattr(part, "id", None), corpus)}
                             for part in validated_ai_entry.relevant_part_texts
                         ]
 
@@ -1,6 +1,8 @@
-from typing import Optional, Literal, Annotated, Union, Dict, Any
+from typing import Optional, Literal, Annotated, Union, Dict, Any, List, Tuple
 
-from pydantic import BaseModel, Field, model_validator
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+
+from src.config import SEARCH_MAX_K, SEARCH_BATCH_MAX_QUERIES, SEARCH_SNIPPET_CHARS
 
 
 # ========== Chat History Models ==========
@@ -58,8 +60,64 @@ class ChatHistoryTurn(BaseModel):
 class InvokeChatbotRequestBody(BaseModel):
     chat_id: Optional[str] = None
     user_input: str
+    # Corpus searched by a new chat, existing chats keep the corpus they were created with
+    corpus: Optional[str] = None
 
 
 class InvokeChatbotStreamingResponse(BaseModel):
     chat: Dict[str, Any]
     turn: ChatHistoryTurn
+
+
+# ========== Search Models ==========
+
+# Restricts the search to matching documents, see src.retriever.filters, unknown filters are rejected
+class SearchFilters(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    types: Optional[List[Literal["cleni", "tocke"]]] = None
+    chapters: Optional[List[str]] = None
+    sections: Optional[List[str]] = None
+    # Inclusive [first, last] range of article numbers
+    articles: Optional[Tuple[int, int]] = None
+
+
+class SearchOptions(BaseModel):
+    k: int = Field(10, ge=1, le=SEARCH_MAX_K, description="Maximum number of returned documents")
+    engine: Literal["tfidf", "bm25", "fusion", "lsa"] = "tfidf"
+    granularity: Literal["documents", "chunks", "parents"] = "documents"
+    filters: Optional[SearchFilters] = None
+    corpus: Optional[str] = None
+    # Cuts the results where their scores drop, see src.retriever.cutoff
+    adaptive: bool = False
+    snippet_chars: int = Field(SEARCH_SNIPPET_CHARS, ge=0, description="Length of the returned text snippets")
+    # Adds the whole element of the corpus each result belongs to
+    include_parts: bool = False
+
+
+class SearchRequestBody(SearchOptions):
+    query: str
+
+
+class SearchBatchRequestBody(SearchOptions):
+    queries: List[str] = Field(max_length=SEARCH_BATCH_MAX_QUERIES)
+
+
+class SearchHit(BaseModel):
+    id: str
+    parent_id: str
+    type: str
+    score: float
+    snippet: str
+    part: Optional[Dict[str, Any]] = None
+
+
+class SearchResponse(BaseModel):
+    query: str
+    results: List[SearchHit]
+    # Reasoning of the adaptive cut-off, if it was used
+    cutoff: Optional[Dict[str, Any]] = None
+
+
+class SearchBatchResponse(BaseModel):
+    responses: List[SearchResponse]
@@ -0,0 +1,24 @@
+import pytest
+from pydantic import ValidationError
+
+from src.api.models import SearchRequestBody
+
+
+def test_filters_are_parsed():
+    body = SearchRequestBody(query="prepovedane prakse",
+                             filters={"types": ["cleni"], "chapters": ["cpt_III"], "articles": [6, 15]})
+    assert body.filters.model_dump(exclude_none=True) == {"types": ["cleni"], "chapters": ["cpt_III"],
+                                                          "articles": (6, 15)}
+
+
+@pytest.mark.parametrize("filters", [
+    {"types": "cleni"},
+    {"chapters": 5},
+    {"types": [1]},
+    {"types": ["clanki"]},
+    {"articles": [6]},
+    {"paragraphs": ["1"]},
+])
+def test_invalid_filters_are_rejected(filters):
+    with pytest.raises(ValidationError):
+        SearchRequestBody(query="prepovedane prakse", filters=filters)
@@ -21,7 +21,7 @@ def get_chat_by_id(chat_id):
     return result
 
 
-def create_chat(name):
+def create_chat(name, corpus=None):
     # Generate a unique chat ID and ensure it does not already exist in the database.
     chat_id = str(uuid.uuid4())
     # This should not happen, but in case it does, we generate a new, nonexistent ID
@@ -30,8 +30,8 @@ def create_chat(name):
 
     try:
         cursor.execute(
-            "INSERT INTO chats (id, name) VALUES (?, ?)",
-            (chat_id, name)
+            "INSERT INTO chats (id, name, corpus) VALUES (?, ?, ?)",
+            (chat_id, name, corpus)
         )
         sqlite_conn.commit()
 
@@ -1,18 +1,17 @@
 from functools import lru_cache
 from typing import Dict, Any
 
-import yaml
+from src.config import DEFAULT_CORPUS
+from src.retriever.chunking import parent_id
+from src.retriever.util import get_document_store
 
-from src.config import AI_ACT_YAML_PATH
 
-with open(AI_ACT_YAML_PATH, "r", encoding="utf-8") as f:
-    ai_act_data = yaml.safe_load(f)
-
-    ai_act_index = {
-        item["id_elementa"]: item
-        for section in ("cleni", "tocke")
-        for item in ai_act_data.get(section, [])
-    }
+def make_snippet(text: str, max_chars: int) -> str:
+    """Returns the beginning of the text, cut at a word boundary if it is longer than max_chars."""
+    if len(text) <= max_chars:
+        return text
+    words = text[:max_chars].rsplit(None, 1)
+    return words[0] + "…" if words else ""
 
 
 def format_sse(data: str, event: str = None) -> str:
@@ -24,7 +23,8 @@ def format_sse(data: str, event: str = None) -> str:
 
 
 @lru_cache(maxsize=1024)
-def get_ai_act_part_by_id(part_id: str) -> Dict[str, Any]:
+def get_part_by_id(part_id: str, corpus: str = DEFAULT_CORPUS) -> Dict[str, Any]:
     if part_id is None:
         return {}
-    return ai_act_index.get(part_id, {})
+    # Chunks of articles are resolved to the article they belong to
+    return get_document_store(corpus).get(parent_id(part_id)) or {}
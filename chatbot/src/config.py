@@ -11,6 +11,108 @@ DATA_DIR = PROJECT_ROOT / "data"
 AI_ACT_YAML_PATH = DATA_DIR / "ai_act.yaml"
 
 TFIDF_EMBEDDINGS_DIR = PROJECT_ROOT / "src" / "retriever" / "tfidf_embeddings"
-EMBEDDINGS_PATH = TFIDF_EMBEDDINGS_DIR / "embeddings.npz"
-METADATA_PATH = TFIDF_EMBEDDINGS_DIR / "metadata.json"
-VECTORIZER_PATH = TFIDF_EMBEDDINGS_DIR / "vectorizer.pkl"
+
+# Regulations that can be searched, each with its source file and its own index directory. Sources are YAML
+# files with lists of articles (cleni) and recitals (tocke), or JSON Lines files with one element per line
+# whose "type" is either of them. Indexes are built with: python -m src.retriever.store_embeddings --corpus <name>
+CORPORA = {
+    "ai_act": {"yaml_path": AI_ACT_YAML_PATH, "index_dir": TFIDF_EMBEDDINGS_DIR},
+}
+# Corpus of chats that do not select one
+DEFAULT_CORPUS = "ai_act"
+# Indexes of corpora are loaded on first use, least recently used ones are unloaded when the
+# index files of loaded corpora exceed this size
+INDEX_MEMORY_BUDGET_MB = 512
+
+# Elements of a corpus compiled from its source file into a memory-mapped store in its index directory, used
+# by the API and the indexer. It is compiled again only when the checksum of the source file changes
+DOCUMENT_STORE_FILE_NAME = "documents.bin"
+# Every index build of a corpus is written to its own directory, the manifest points to the build in use
+INDEX_BUILDS_DIR_NAME = "builds"
+INDEX_MANIFEST_FILE_NAME = "manifest.json"
+# Number of index builds kept on disk, including the one in use
+INDEX_BUILDS_KEPT = 3
+# Vocabulary, TF-IDF matrix and document metadata of a build, in a single memory-mappable file
+INDEX_FILE_NAME = "index.bin"
+# The same for paragraphs and points of articles (chunks), each referring to its parent element
+CHUNK_INDEX_FILE_NAME = "chunks.bin"
+# Seconds between checks of the manifest for a new index build, which is then loaded without restarting the API
+# (0 disables the check, builds can still be loaded with POST /admin/reload-index)
+INDEX_WATCH_INTERVAL = 10
+# Elements of a corpus are read, lemmatized and counted this many at a time while building its index,
+# so their texts and lemmas are never all held in memory
+INGEST_BATCH_SIZE = 1000
+# Paragraphs longer than this are split further into their points
+CHUNK_MAX_CHARS = 1500
+# When searching chunks for parent documents, this many chunks per requested document are searched
+PARENT_CHUNK_OVERFETCH = 4
+# Lemmatized texts and content hashes of indexed elements of a corpus, used for incremental re-indexing
+LEMMA_STORE_FILE_NAME = "lemmas.sqlite"
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Reciprocal-rank fusion of BM25 and TF-IDF: rank constant and number of documents ranked by each engine
+RRF_K = 60
+RRF_DEPTH = 100
+# Dimensions of the LSA document vectors stored in the index (0 disables the LSA engine)
+LSA_COMPONENTS = 128
+# Indexes with more documents than this are split into shards of this many rows, searched in parallel
+# by SEARCH_THREADS threads
+SEARCH_SHARD_SIZE = 100_000
+SEARCH_THREADS = 4
+# Adaptive number of documents of the RAG step: of up to k found documents, the ranking is cut before the first
+# document scored below ADAPTIVE_MIN_SCORE of its engine, below ADAPTIVE_MIN_RATIO of the top score, or lower than
+# the previous document by more than ADAPTIVE_MAX_GAP of the top score, keeping at least ADAPTIVE_MIN_DOCUMENTS.
+# Minimum scores are set only for engines with cosine similarity scores, fusion scores are nearly flat by design
+RETRIEVER_ADAPTIVE = True
+ADAPTIVE_MIN_SCORE = {"tfidf": 0.05, "lsa": 0.15}
+ADAPTIVE_MIN_RATIO = 0.5
+ADAPTIVE_MAX_GAP = 0.25
+ADAPTIVE_MIN_DOCUMENTS = 3
+# Number of search engines restricted to the rows of distinct search filters, kept per index
+FILTERED_ENGINE_CACHE_SIZE = 64
+
+# Retrieval-only /search endpoints: maximum number of results and of queries of a batch, length of text snippets
+SEARCH_MAX_K = 100
+SEARCH_BATCH_MAX_QUERIES = 100
+SEARCH_SNIPPET_CHARS = 300
+
+# Questions with expected element ids, used by the retrieval benchmark
+BENCHMARK_QUESTIONS_PATH = DATA_DIR / "benchmark_questions.yaml"
+
+# Query caches (lemmatized queries and top-k search results)
+QUERY_CACHE_SIZE = 4096
+# Set to True to persist query caches to a local SQLite file, so they survive restarts
+PERSIST_QUERY_CACHE = False
+QUERY_CACHE_PATH = DB_DIR / "query_cache.sqlite"
+
+# Download the classla Slovene model on first use if it is not installed (the Docker image installs it at build time)
+CLASSLA_DOWNLOAD_MISSING = True
+
+# Query lemmatization service: worker threads, each with its own classla pipeline, which lemmatize
+# concurrent queries in batches. Set LEMMATIZER_WORKERS to 0 to lemmatize in the calling thread instead.
+# Each worker loads its own pipeline, so more workers pay off only on machines with spare cores and memory.
+LEMMATIZER_WORKERS = 1
+LEMMATIZER_BATCH_WINDOW = 0.005  # seconds to wait for further queries, only while queries are queueing up
+LEMMATIZER_MAX_BATCH_SIZE = 32
+# Lemmatizer of queries: "dictionary" looks up lemmas in the table of word forms stored in the index and
+# lemmatizes only unknown words with classla, "classla" lemmatizes whole queries with classla. The committed index
+# build contains no table of word forms, so set "dictionary" only once the index is rebuilt with make store.
+QUERY_LEMMATIZER = "classla"
+
+# Chatbot graph: classify the query, rephrase it and retrieve documents for it in parallel, instead of rephrasing
+# and retrieving only after the query is classified as related to the AI Act
+CHATBOT_PARALLEL_FRONT = True
+# Extract relevant passages of the RAG answer while it is validated, instead of only after it is validated
+CHATBOT_PARALLEL_TAIL = True
+
+# Answer cache of the chatbot: answers to AI Act questions are stored and replayed, without any LLM calls, for later
+# questions whose rephrased form has TF-IDF cosine similarity of at least ANSWER_CACHE_MIN_SIMILARITY and which share
+# at least ANSWER_CACHE_MIN_OVERLAP of retrieved documents. Entries expire after ANSWER_CACHE_TTL seconds, the least
+# recently used are evicted above ANSWER_CACHE_SIZE entries, and entries of older index versions are dropped.
+CHATBOT_ANSWER_CACHE = True
+ANSWER_CACHE_PATH = DB_DIR / "answer_cache.sqlite"
+ANSWER_CACHE_SIZE = 1000
+ANSWER_CACHE_TTL = 7 * 24 * 60 * 60
+ANSWER_CACHE_MIN_SIMILARITY = 0.9
+ANSWER_CACHE_MIN_OVERLAP = 0.6
@@ -0,0 +1,128 @@
+import json
+import sqlite3
+import time
+from threading import Lock
+
+import numpy as np
+
+
+def cosine_similarity(indices_a, weights_a, indices_b, weights_b):
+    """Returns cosine similarity of two L2-normalized sparse vectors, given by sorted term indices and weights."""
+    _, a, b = np.intersect1d(indices_a, indices_b, assume_unique=True, return_indices=True)
+    return float(np.dot(weights_a[a], weights_b[b]))
+
+
+def document_overlap(ids_a, ids_b):
+    """Returns the share of documents retrieved for either query that were retrieved for both (Jaccard similarity)."""
+    ids_a, ids_b = set(ids_a), set(ids_b)
+    return len(ids_a & ids_b) / max(len(ids_a | ids_b), 1)
+
+
+class AnswerCache:
+    """Answers to RAG questions, looked up by similarity of the (rephrased) questions, persisted to a SQLite file.
+
+    An entry answers a question if the cosine similarity of TF-IDF vectors of both questions is at least
+    min_similarity and at least min_overlap of the documents retrieved for either of them were retrieved for both,
+    so the answer is based on the same documents. Entries are dropped ttl seconds after they are stored, and the
+    least recently used ones once there are more than max_entries. Entries of a corpus made with another index
+    version are dropped when the corpus is looked up, as term indices of their vectors no longer apply.
+
+    Values of entries must be JSON serializable.
+    """
+
+    def __init__(self, path, max_entries, ttl, min_similarity, min_overlap):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.min_overlap = min_overlap
+        self._lock = Lock()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                corpus TEXT,
+                version TEXT,
+                query TEXT,
+                term_indices BLOB,
+                term_weights BLOB,
+                document_ids TEXT,
+                value TEXT,
+                created_at REAL,
+                accessed_at REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_corpus_version ON answers (corpus, version)")
+        self._conn.commit()
+
+    def get(self, corpus, version, vector, document_ids):
+        """Returns (stored value, query of the entry, similarity) of the most similar matching entry, or None.
+
+        The vector is the (1 x terms) TF-IDF vector of the question made with the index of the given version.
+        """
+        if vector.nnz == 0:
+            return None
+        indices, weights = self._encode(vector)
+
+        with self._lock:
+            now = time.time()
+            self._conn.execute("DELETE FROM answers WHERE created_at < ? OR (corpus = ? AND version != ?)",
+                               (now - self.ttl, corpus, version))
+            rows = self._conn.execute(
+                "SELECT id, query, term_indices, term_weights, document_ids FROM answers "
+                "WHERE corpus = ? AND version = ?", (corpus, version)
+            ).fetchall()
+
+            best, best_similarity = None, self.min_similarity
+            for entry_id, query, entry_indices, entry_weights, entry_document_ids in rows:
+                similarity = cosine_similarity(indices, weights, np.frombuffer(entry_indices, dtype=np.int32),
+                                               np.frombuffer(entry_weights, dtype=np.float32))
+                if similarity >= best_similarity and \
+                        document_overlap(document_ids, json.loads(entry_document_ids)) >= self.min_overlap:
+                    best, best_similarity = (entry_id, query), similarity
+
+            if best is None:
+                self._conn.commit()
+                return None
+
+            entry_id, query = best
+            self._conn.execute("UPDATE answers SET accessed_at = ? WHERE id = ?", (now, entry_id))
+            value = self._conn.execute("SELECT value FROM answers WHERE id = ?", (entry_id,)).fetchone()[0]
+            self._conn.commit()
+            return json.loads(value), query, best_similarity
+
+    def put(self, corpus, version, query, vector, document_ids, value):
+        """Stores the value for the question, questions without any known terms are not stored."""
+        if vector.nnz == 0:
+            return
+        indices, weights = self._encode(vector)
+
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "INSERT INTO answers (corpus, version, query, term_indices, term_weights, document_ids, value, "
+                "created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (corpus, version, query, indices.tobytes(), weights.tobytes(), json.dumps(list(document_ids)),
+                 json.dumps(value), now, now)
+            )
+            self._conn.execute(
+                "DELETE FROM answers WHERE id NOT IN (SELECT id FROM answers ORDER BY accessed_at DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    @staticmethod
+    def _encode(vector):
+        vector = vector.tocsr()
+        vector.sort_indices()
+        return vector.indices.astype(np.int32), vector.data.astype(np.float32)
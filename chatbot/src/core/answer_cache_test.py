@@ -0,0 +1,67 @@
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from src.core.answer_cache import AnswerCache
+
+VECTORIZER = TfidfVectorizer().fit([
+    "visoko tvegan sistem umetna inteligenca",
+    "prepovedan praksa biometrija",
+    "kazen globa organ",
+])
+ANSWER = {"answer": "Odgovor", "top_3": [{"page_content": "Besedilo", "metadata": {"id": "art_6"}}],
+          "relevant_part_texts": [{"id": "art_6", "text": ["Besedilo"]}]}
+
+
+def vector(query):
+    return VECTORIZER.transform([query])
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = AnswerCache(tmp_path / "answer_cache.sqlite", max_entries=2, ttl=60, min_similarity=0.9, min_overlap=0.6)
+    cache.put("ai_act", "v1", "visoko tvegan sistem", vector("visoko tvegan sistem"), ["art_6", "art_7"], ANSWER)
+    return cache
+
+
+def test_similar_query_with_same_documents_is_a_hit(cache):
+    value, query, similarity = cache.get("ai_act", "v1", vector("sistem visoko tvegan"), ["art_7", "art_6"])
+    assert value == ANSWER
+    assert query == "visoko tvegan sistem"
+    assert similarity == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("corpus, query, documents", [
+    ("ai_act", "kazen globa", ["art_6", "art_7"]),  # dissimilar query
+    ("ai_act", "sistem visoko tvegan", ["art_6", "art_99", "art_100"]),  # mostly other documents
+    ("ai_act", "neznana beseda", ["art_6", "art_7"]),  # no known terms
+    ("other", "visoko tvegan sistem", ["art_6", "art_7"]),  # other corpus
+])
+def test_miss(cache, corpus, query, documents):
+    assert cache.get(corpus, "v1", vector(query), documents) is None
+
+
+def test_least_recently_used_entry_is_evicted(cache):
+    cache.put("ai_act", "v1", "kazen globa", vector("kazen globa"), ["art_99"], {"answer": "Globe"})
+    # Using the first entry makes the second one least recently used
+    assert cache.get("ai_act", "v1", vector("visoko tvegan sistem"), ["art_6", "art_7"]) is not None
+    cache.put("ai_act", "v1", "prepovedan praksa", vector("prepovedan praksa"), ["art_5"], {"answer": "Prakse"})
+
+    assert len(cache) == 2
+    assert cache.get("ai_act", "v1", vector("kazen globa"), ["art_99"]) is None
+    assert cache.get("ai_act", "v1", vector("visoko tvegan sistem"), ["art_6", "art_7"]) is not None
+
+
+def test_expired_entry_is_dropped(cache):
+    cache.ttl = -1
+    assert cache.get("ai_act", "v1", vector("visoko tvegan sistem"), ["art_6", "art_7"]) is None
+    assert len(cache) == 0
+
+
+def test_entries_of_other_index_versions_are_dropped(cache):
+    assert cache.get("ai_act", "v2", vector("visoko tvegan sistem"), ["art_6", "art_7"]) is None
+    assert len(cache) == 0
+
+
+def test_entries_persist_across_instances(cache, tmp_path):
+    reopened = AnswerCache(tmp_path / "answer_cache.sqlite", 2, 60, 0.9, 0.6)
+    assert reopened.get("ai_act", "v1", vector("visoko tvegan sistem"), ["art_6", "art_7"])[0] == ANSWER
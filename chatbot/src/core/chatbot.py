@@ -1,4 +1,6 @@
+from collections import Counter
 from enum import Enum
+from threading import Lock
 from typing import TypedDict, Annotated
 from langchain_core.documents import Document
 from langchain_core.messages import AIMessage
@@ -10,13 +12,18 @@ from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.checkpoint.sqlite import SqliteSaver
 from langgraph.config import get_stream_writer
-from langgraph.constants import END
+from langgraph.constants import START, END
 from langgraph.graph import StateGraph, add_messages
 from pydantic import BaseModel, Field
 
+from src.config import DEFAULT_CORPUS, RETRIEVER_ADAPTIVE, CHATBOT_PARALLEL_FRONT, CHATBOT_PARALLEL_TAIL, \
+    CHATBOT_ANSWER_CACHE, ANSWER_CACHE_PATH, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_MIN_SIMILARITY, \
+    ANSWER_CACHE_MIN_OVERLAP
 from src.core.ai_act_summary import AI_ACT_SUMMARY
+from src.core.answer_cache import AnswerCache
 from src.db import sqlite_conn
 from src.retriever.TFIDFRetriever import TFIDFRetriever
+from src.retriever.util import get_snapshot, preprocess
 
 
 # ------------ Enum for memory type ------------
@@ -92,9 +99,43 @@ class AgentState(TypedDict):
     top_3: list[Document]
     relevant_part_texts: list[RelevantPassage]
     valid_rag_answer: str
+    corpus: str
+    # Documents retrieved for the raw user query while the query is being rephrased (parallel front of the graph)
+    speculative_query: str
+    speculative_docs: list[Document]
+    # Documents retrieved for the rephrased query, and the answer found for it in the answer cache
+    retrieved_docs: list[Document]
+    cached_answer: dict
+
+
+# One retriever per corpus, chats search the corpus they were created with
+# Up to 10 documents are retrieved, fewer if their scores drop (RETRIEVER_ADAPTIVE)
+retrievers = {DEFAULT_CORPUS: TFIDFRetriever(k=10, adaptive=RETRIEVER_ADAPTIVE)}
+
+
+def get_retriever(corpus):
+    corpus = corpus or DEFAULT_CORPUS
+    if corpus not in retrievers:
+        retrievers[corpus] = TFIDFRetriever(k=10, corpus=corpus, adaptive=RETRIEVER_ADAPTIVE)
+    return retrievers[corpus]
+
+
+# Answers to AI Act questions, shared by all chats and replayed for similar questions (CHATBOT_ANSWER_CACHE).
+# Its SQLite file is opened on first use, so it is not created when the cache is not used.
+_answer_cache = None
+_answer_cache_lock = Lock()
+
+
+def get_answer_cache():
+    global _answer_cache
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                _answer_cache = AnswerCache(ANSWER_CACHE_PATH, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL,
+                                            ANSWER_CACHE_MIN_SIMILARITY, ANSWER_CACHE_MIN_OVERLAP)
+    return _answer_cache
 
 
-retriever = TFIDFRetriever(k=10)
 query_history_relation_parser = PydanticOutputParser(pydantic_object=QueryHistoryRelationParser)
 query_classification_parser = PydanticOutputParser(pydantic_object=QueryClassificationParser)
 top_3_parser = PydanticOutputParser(pydantic_object=Top3Response)
@@ -289,6 +330,53 @@ def rephrase_query(state):
     }
 
 
+def speculative_retrieval(state):
+    print("-- Retrieving documents for the original user query --")
+
+    query = state["messages"][-1].content
+    try:
+        docs = get_retriever(state.get("corpus")).invoke(query)
+    except Exception as e:
+        # Documents are retrieved again in the RAG step, a failed speculation must not fail the turn
+        print(f">> Speculative retrieval failed: {e}")
+        return {"speculative_query": None, "speculative_docs": None}
+    return {"speculative_query": query, "speculative_docs": docs}
+
+
+def join_front(state):
+    """Waits for classification, rephrasing and speculative retrieval, which run in parallel."""
+    return {}
+
+
+# Numbers of RAG turns whose documents were retrieved speculatively, and of those that reused them
+speculation_stats = Counter()
+
+
+def same_search_terms(query, other_query, corpus):
+    """Returns True if both queries have the same lemmas (regardless of order), so they retrieve the same documents."""
+    return sorted(preprocess(query, corpus=corpus).split()) == sorted(preprocess(other_query, corpus=corpus).split())
+
+
+def retrieve(state):
+    """Returns documents retrieved for the rephrased query, reusing the speculative ones if its search terms are unchanged.
+
+    Rephrasing mostly drops pleasantries and stopwords, which are not search terms, so queries are compared
+    by their preprocessed (lemmatized, stopword-free) forms, which are cached from the speculative retrieval.
+    """
+    query = state["query"]
+    corpus = state.get("corpus") or DEFAULT_CORPUS
+    if state.get("speculative_docs") is not None and state.get("speculative_query") is not None:
+        speculation_stats["speculated"] += 1
+        if same_search_terms(state["speculative_query"], query, corpus):
+            speculation_stats["reused"] += 1
+            print(f">> Reusing documents retrieved for the original query (reused in {speculation_stats['reused']} "
+                  f"of {speculation_stats['speculated']} turns)")
+            return state["speculative_docs"]
+        print(f">> Search terms of the rephrased query differ, retrieving again (reused in "
+              f"{speculation_stats['reused']} of {speculation_stats['speculated']} turns)")
+    return get_retriever(corpus).invoke(query)
+
+
 def rag_function(state):
     print("-- Calling RAG --")
     writer = get_stream_writer()
@@ -320,7 +408,14 @@ def rag_function(state):
     {format_instructions}
     """
 
-    retrieved_docs = retriever.invoke(query)
+    # Documents are already retrieved if the answer cache was looked up
+    retrieved_docs = state.get("retrieved_docs")
+    if retrieved_docs is None:
+        retrieved_docs = retrieve(state)
+
+    # With adaptive retrieval, all candidates may already fit in the top 3, so there is nothing to select
+    if len(retrieved_docs) <= 3:
+        return {"top_3": retrieved_docs}
 
     # print(", ".join([
     #     f"ID: {doc.metadata['id']}"
@@ -583,13 +678,12 @@ def invalid_rag_answer(state):
     }
 
 
-def valid_rag_answer(state):
-    print("-- Getting Relevant Passages And Appending Valid RAG Answer To Chat History --")
+def extract_relevant_passages(state):
+    print("-- Getting Relevant Passages Of RAG Answer --")
     writer = get_stream_writer()
-    writer({"intermediate_step": "Getting Relevant Passages And Appending Valid RAG Answer To Chat History"})
+    writer({"intermediate_step": "Getting Relevant Passages Of RAG Answer"})
 
     valid_answer = state["answer"]
-    human_msg_id = state["messages"][-1].id
 
     query = state["query"]
     original_query = state["messages"][-1]
@@ -678,14 +772,108 @@ def valid_rag_answer(state):
 
     response = chain.invoke({"answer": valid_answer, "query": query, "original_query": original_query.content, "top_3": get_context(state["top_3"])})
 
+    return {"relevant_part_texts": response.RelevantPassages}
+
+
+def append_valid_rag_answer(state):
+    print("-- Appending Valid RAG Answer To Chat History --")
+
+    relevant_part_texts = state["relevant_part_texts"]
+    human_msg_id = state["messages"][-1].id
+
     return {
         # Append valid RAG answer to chat history
-        "relevant_part_texts": response.RelevantPassages,
-        "messages": [AIMessage(content=valid_answer, response_metadata={"relevant_part_texts": response.RelevantPassages},
+        "messages": [AIMessage(content=state["answer"], response_metadata={"relevant_part_texts": relevant_part_texts},
                                additional_kwargs={"parent_id": human_msg_id})]
     }
 
 
+def valid_rag_answer(state):
+    """Extracts relevant passages of a validated answer and appends the answer to chat history."""
+    passages = extract_relevant_passages(state)
+    return {**passages, **append_valid_rag_answer({**state, **passages})}
+
+
+def answer_cache_key(state, retrieved_docs):
+    """Returns (corpus, index version, TF-IDF vector of the rephrased query, ids of retrieved documents)."""
+    corpus = state.get("corpus") or DEFAULT_CORPUS
+    # Vector is made with the vectorizer of the version it is stored with, even if a new index is loaded meanwhile
+    snapshot = get_snapshot(corpus)
+    vector = snapshot.documents.get_vectorizer().transform([preprocess(state["query"], corpus=corpus)])
+    return corpus, snapshot.version, vector, [doc.metadata["id"] for doc in retrieved_docs]
+
+
+def lookup_answer(state):
+    print("-- Looking Up Answer Cache --")
+    writer = get_stream_writer()
+    writer({"intermediate_step": "Looking up answer cache"})
+
+    retrieved_docs = retrieve(state)
+    try:
+        cached = get_answer_cache().get(*answer_cache_key(state, retrieved_docs))
+    except Exception as e:
+        # The answer is generated as if it was not cached, a failed lookup must not fail the turn
+        print(f">> Answer cache lookup failed: {e}")
+        cached = None
+
+    if cached is None:
+        return {"retrieved_docs": retrieved_docs, "cached_answer": None}
+    value, cached_query, similarity = cached
+    print(f">> Found answer to \"{cached_query}\" (similarity {similarity:.3f})")
+    return {"retrieved_docs": retrieved_docs, "cached_answer": value}
+
+
+def answer_cache_router(state):
+    print("-- Answer Cache Router --")
+
+    if state.get("cached_answer") is not None:
+        print(">> DECISION: Cached")
+        return "Cached"
+    print(">> DECISION: Not Cached")
+    return "Not Cached"
+
+
+def cached_rag_answer(state):
+    print("-- Appending Cached RAG Answer To Chat History --")
+    writer = get_stream_writer()
+    writer({"intermediate_step": "Answer found in answer cache"})
+
+    cached = state["cached_answer"]
+    relevant_part_texts = [RelevantPassage(**passage) for passage in cached["relevant_part_texts"]]
+    human_msg_id = state["messages"][-1].id
+
+    return {
+        "answer": cached["answer"],
+        "top_3": [Document(**doc) for doc in cached["top_3"]],
+        "relevant_part_texts": relevant_part_texts,
+        "valid_rag_answer": "Valid",
+        "messages": [AIMessage(content=cached["answer"], response_metadata={"relevant_part_texts": relevant_part_texts},
+                               additional_kwargs={"parent_id": human_msg_id})]
+    }
+
+
+def store_answer(state):
+    """Stores the valid RAG answer in the answer cache, with the documents and passages it is based on."""
+    print("-- Storing RAG Answer In Answer Cache --")
+
+    value = {
+        "answer": state["answer"],
+        "top_3": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in state["top_3"]],
+        "relevant_part_texts": [passage.model_dump() for passage in state["relevant_part_texts"]],
+    }
+    try:
+        corpus, version, vector, document_ids = answer_cache_key(state, state["retrieved_docs"])
+        get_answer_cache().put(corpus, version, state["query"], vector, document_ids, value)
+    except Exception as e:
+        print(f">> Storing answer in answer cache failed: {e}")
+    return {}
+
+
+def join_tail(state):
+    """Waits for validation of the RAG answer and extraction of its passages, which run in parallel."""
+    return {}
+
+
 def answer_validation_router(state):
     print("-- RAG Answer Validation Router --")
 
@@ -698,7 +886,20 @@ def answer_validation_router(state):
         return "Invalid"
 
 
-def build_chatbot(memory_type: MemoryType = MemoryType.MEMORY):
+def build_chatbot(memory_type: MemoryType = MemoryType.MEMORY, parallel_front: bool = CHATBOT_PARALLEL_FRONT,
+                  parallel_tail: bool = CHATBOT_PARALLEL_TAIL, use_answer_cache: bool = CHATBOT_ANSWER_CACHE):
+    """Builds the chatbot graph.
+
+    With parallel_front, the query is classified, rephrased and documents are retrieved for the original
+    query at the same time, instead of rephrasing only after classification. Answers to AI Act questions
+    start one LLM round trip earlier, the rephrased query and documents are discarded for other questions.
+
+    With parallel_tail, relevant passages of the RAG answer are extracted while the answer is validated,
+    instead of only after it is validated, and are discarded if the answer is invalid.
+
+    With use_answer_cache, valid RAG answers are stored in the answer cache and replayed, without any LLM calls,
+    for similar rephrased questions that retrieve mostly the same documents (see src.core.answer_cache).
+    """
     workflow = StateGraph(AgentState)
 
     workflow.add_node("Classify_Query_Relevance", classify_query_relevance)
@@ -708,23 +909,71 @@ def build_chatbot(memory_type: MemoryType = MemoryType.MEMORY):
     workflow.add_node("RAG_Answer", rag_answer_function)
     workflow.add_node("Validate_RAG_Answer", validate_answer)
     workflow.add_node("Invalid_RAG_Answer", invalid_rag_answer)
-    workflow.add_node("Valid_RAG_Answer", valid_rag_answer)
-
-    workflow.set_entry_point("Classify_Query_Relevance")
+    workflow.add_node("Valid_RAG_Answer", append_valid_rag_answer if parallel_tail else valid_rag_answer)
+
+    # AI Act questions are answered from the answer cache if possible
+    rag_entry = "RAG"
+    if use_answer_cache:
+        workflow.add_node("Answer_Cache", lookup_answer)
+        workflow.add_node("Cached_RAG_Answer", cached_rag_answer)
+        workflow.add_node("Store_Answer", store_answer)
+
+        workflow.add_conditional_edges(
+            "Answer_Cache",
+            answer_cache_router,
+            {
+                "Cached": "Cached_RAG_Answer",
+                "Not Cached": "RAG",
+            }
+        )
+        workflow.add_edge("Cached_RAG_Answer", END)
+        rag_entry = "Answer_Cache"
+
+    if parallel_front:
+        workflow.add_node("Speculative_Retrieval", speculative_retrieval)
+        workflow.add_node("Join_Front", join_front)
+
+        front = ["Classify_Query_Relevance", "Rephrase_Query", "Speculative_Retrieval"]
+        for node in front:
+            workflow.add_edge(START, node)
+        # Routed once all branches are done
+        workflow.add_edge(front, "Join_Front")
+        workflow.add_conditional_edges(
+            "Join_Front",
+            relevance_router,
+            {
+                "RAG Call": rag_entry,
+                "LLM Call": "LLM",
+            }
+        )
+    else:
+        workflow.set_entry_point("Classify_Query_Relevance")
+
+        workflow.add_conditional_edges(
+            "Classify_Query_Relevance",
+            relevance_router,
+            {
+                "RAG Call": "Rephrase_Query",
+                "LLM Call": "LLM",
+            }
+        )
+        workflow.add_edge("Rephrase_Query", rag_entry)
 
-    workflow.add_conditional_edges(
-        "Classify_Query_Relevance",
-        relevance_router,
-        {
-            "RAG Call": "Rephrase_Query",
-            "LLM Call": "LLM",
-        }
-    )
-    workflow.add_edge("Rephrase_Query", "RAG")
     workflow.add_edge("RAG", "RAG_Answer")
-    workflow.add_edge("RAG_Answer", "Validate_RAG_Answer")
+    if parallel_tail:
+        workflow.add_node("Extract_Relevant_Passages", extract_relevant_passages)
+        workflow.add_node("Join_Tail", join_tail)
+
+        tail = ["Validate_RAG_Answer", "Extract_Relevant_Passages"]
+        for node in tail:
+            workflow.add_edge("RAG_Answer", node)
+        workflow.add_edge(tail, "Join_Tail")
+        validated = "Join_Tail"
+    else:
+        workflow.add_edge("RAG_Answer", "Validate_RAG_Answer")
+        validated = "Validate_RAG_Answer"
     workflow.add_conditional_edges(
-        "Validate_RAG_Answer",
+        validated,
         answer_validation_router,
         {
             "Valid": "Valid_RAG_Answer",
@@ -733,7 +982,11 @@ def build_chatbot(memory_type: MemoryType = MemoryType.MEMORY):
     )
     workflow.add_edge("LLM", END)
     workflow.add_edge("Invalid_RAG_Answer", END)
-    workflow.add_edge("Valid_RAG_Answer", END)
+    if use_answer_cache:
+        workflow.add_edge("Valid_RAG_Answer", "Store_Answer")
+        workflow.add_edge("Store_Answer", END)
+    else:
+        workflow.add_edge("Valid_RAG_Answer", END)
 
     if memory_type == MemoryType.MEMORY:
         memory = MemorySaver()  # Chat history persists only on current script run
@@ -17,11 +17,18 @@ def init_db():
 
         if table_exists:
             print("Chats table already exists.")
+            # Chats created before corpora could be selected search the default corpus
+            cursor.execute("PRAGMA table_info(chats)")
+            if "corpus" not in [column["name"] for column in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE chats ADD COLUMN corpus TEXT")
+                sqlite_conn.commit()
+                print("Chats table column corpus ADDED.")
         else:
             cursor.execute("""
             CREATE TABLE chats (
                 id TEXT UNIQUE PRIMARY KEY,
                 name TEXT,
+                corpus TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
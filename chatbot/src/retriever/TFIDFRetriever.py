@@ -1,10 +1,14 @@
-from typing import List
+from typing import List, Optional, Any, Dict
 
 from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import RunnableConfig
 
-from src.retriever.search import search_documents
+from src.config import DEFAULT_CORPUS, ADAPTIVE_MIN_SCORE, ADAPTIVE_MIN_RATIO, ADAPTIVE_MAX_GAP, \
+    ADAPTIVE_MIN_DOCUMENTS
+from src.retriever.cutoff import cut_documents
+from src.retriever.search import search_documents, search_documents_many
 
 
 class TFIDFRetriever(BaseRetriever):
@@ -21,12 +25,59 @@ class TFIDFRetriever(BaseRetriever):
 
     k: int
     """Number of top results to return"""
+    engine: str = "tfidf"
+    """Search engine: "tfidf" or "bm25" for term matching, "fusion" for reciprocal-rank fusion of both,
+    or "lsa" for latent semantic search"""
+    granularity: str = "documents"
+    """Returned documents: "documents" for whole elements, "chunks" for paragraphs and points of articles,
+    or "parents" for elements whose chunks match the query best"""
+    filters: Optional[Dict[str, Any]] = None
+    """Restricts the search to documents of the given "types", "chapters", "sections" and a (first, last) range
+    of "articles", e.g. {"types": ["cleni"], "chapters": ["cpt_III"]}"""
+    corpus: str = DEFAULT_CORPUS
+    """Name of the searched corpus, one of CORPORA in src.config"""
+    adaptive: bool = False
+    """Returns fewer than k documents when their scores drop, with the reasoning in "cutoff" metadata of the
+    documents (see src.retriever.cutoff), k is then the upper bound"""
+    min_score: Optional[float] = None
+    """Adaptive mode: minimum similarity score, by default ADAPTIVE_MIN_SCORE of the engine"""
+    min_ratio: float = ADAPTIVE_MIN_RATIO
+    """Adaptive mode: minimum share of the top score"""
+    max_gap: float = ADAPTIVE_MAX_GAP
+    """Adaptive mode: maximum drop of score between consecutive documents, as a share of the top score"""
+    min_documents: int = ADAPTIVE_MIN_DOCUMENTS
+    """Adaptive mode: number of documents kept regardless of their scores"""
+
+    def _cut(self, documents: List[Document]) -> List[Document]:
+        if not self.adaptive:
+            return documents
+        min_score = self.min_score if self.min_score is not None else ADAPTIVE_MIN_SCORE.get(self.engine)
+        return cut_documents(documents, min_score, self.min_ratio, self.max_gap, self.min_documents)
 
     def _get_relevant_documents(
             self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> List[Document]:
         """Sync implementations for retrievers."""
-        return search_documents(query, self.k)
+        return self._cut(search_documents(query, self.k, self.engine, self.granularity, self.filters, self.corpus))
+
+    def batch(
+            self,
+            inputs: List[str],
+            config: Optional[RunnableConfig | List[RunnableConfig]] = None,
+            *,
+            return_exceptions: bool = False,
+            **kwargs: Optional[Any],
+    ) -> List[List[Document]]:
+        """Retrieves documents for all queries at once, with a single lemmatization pass and similarity product."""
+        if not inputs:
+            return []
+        try:
+            return [self._cut(documents) for documents in
+                    search_documents_many(inputs, self.k, self.engine, self.granularity, self.filters, self.corpus)]
+        except Exception as e:
+            if return_exceptions:
+                return [e for _ in inputs]
+            raise e
 
     # Optional: Provide a more efficient native implementation by overriding
     # _aget_relevant_documents
@@ -0,0 +1,265 @@
+import argparse
+import json
+import resource
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import yaml
+
+from src.config import BENCHMARK_QUESTIONS_PATH
+from src.retriever.search import search, search_documents, search_documents_many
+from src.retriever.lemmatizer import WORD_PATTERN
+from src.retriever.util import get_embedding_manager, preprocess, preprocess_many, search_cache, lemmatize_many
+
+
+def load_questions(path=BENCHMARK_QUESTIONS_PATH):
+    """Returns (question, set of expected element ids) pairs."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+    return [(q["vprasanje"], set(q["pricakovani"])) for q in data["vprasanja"]]
+
+
+def recall_at_k(retrieved_ids, expected_ids, k):
+    return len(expected_ids & set(retrieved_ids[:k])) / len(expected_ids)
+
+
+def summarize_latencies(latencies):
+    """Returns mean and percentiles of latencies (in seconds) in milliseconds."""
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "mean": float(latencies_ms.mean()),
+        "p50": float(np.percentile(latencies_ms, 50)),
+        "p95": float(np.percentile(latencies_ms, 95)),
+        "p99": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def time_calls(function, inputs, repeat, before_call=None):
+    """Calls the function with each of the inputs repeat times, returns latencies and throughput of the calls."""
+    latencies = []
+    for _ in range(repeat):
+        for value in inputs:
+            if before_call is not None:
+                before_call()
+            start = time.perf_counter()
+            function(value)
+            latencies.append(time.perf_counter() - start)
+    return {"latency_ms": summarize_latencies(latencies), "throughput_qps": len(latencies) / sum(latencies)}
+
+
+def benchmark_stages(questions, top_n, engine, granularity, repeat=10):
+    """Measures latency of each stage of retrieval, without the help of query caches.
+
+    Stage "search" and "search_documents" include searching and formatting the results, but not lemmatization,
+    whose results stay cached, so preprocessing is only measured in stage "preprocess". The search cache
+    is cleared before each call.
+    """
+    queries = [question for question, _ in questions]
+    preprocess_many(queries)
+
+    stages = {
+        "preprocess": time_calls(lambda q: preprocess(q, use_cache=False), queries, repeat),
+        "search": time_calls(lambda q: search(q, top_n, engine, granularity), queries, repeat, search_cache.clear),
+        "search_documents": time_calls(lambda q: search_documents(q, top_n, engine, granularity), queries, repeat,
+                                       search_cache.clear),
+    }
+
+    # Throughput of a single batched search of all questions
+    search_cache.clear()
+    start = time.perf_counter()
+    search_documents_many(queries, top_n, engine, granularity)
+    stages["search_documents_many"] = {"batch_size": len(queries),
+                                       "throughput_qps": len(queries) / (time.perf_counter() - start)}
+    return stages
+
+
+def evaluate_recall(questions, ks, engine, granularity):
+    """Returns recall@k of search_documents, matching expected ids against ids of the (parent) elements."""
+    search_cache.clear()
+    retrieved = [
+        [document.metadata["parent_id"] for document in search_documents(question, max(ks), engine, granularity)]
+        for question, _ in questions
+    ]
+    # Chunks of the same element count only once
+    retrieved = [list(dict.fromkeys(ids)) for ids in retrieved]
+    return {k: float(np.mean([recall_at_k(r, e, k) for r, (_, e) in zip(retrieved, questions)])) for k in ks}
+
+
+def benchmark_engine(name, query_vectors, expected, ks, repeat=10):
+    """Measures recall@k and per-query search latency of the engine, bypassing the search cache."""
+    embedding_manager = get_embedding_manager()
+    engine = embedding_manager.get_search_engine(name)
+    metadata = embedding_manager.get_metadata()
+    top_n = max(ks)
+
+    latencies = []
+    for _ in range(repeat):
+        for i in range(query_vectors.shape[0]):
+            start = time.perf_counter()
+            engine.search(query_vectors[i], top_n)
+            latencies.append(time.perf_counter() - start)
+
+    retrieved = [
+        [metadata.get_id(j) for j in engine.search(query_vectors[i], top_n)[0]]
+        for i in range(query_vectors.shape[0])
+    ]
+    return {
+        "recall": {k: float(np.mean([recall_at_k(r, e, k) for r, e in zip(retrieved, expected)])) for k in ks},
+        "latency_ms": summarize_latencies(latencies),
+    }
+
+
+def compare_engines(questions, engines, ks, repeat=10):
+    embedding_manager = get_embedding_manager()
+    embedding_manager.load_embeddings()
+
+    # Queries are lemmatized once up front, so only the search itself is measured
+    preprocessed = preprocess_many([question for question, _ in questions])
+    query_vectors = embedding_manager.get_vectorizer().transform(preprocessed)
+    expected = [expected_ids for _, expected_ids in questions]
+
+    return {name: benchmark_engine(name, query_vectors, expected, ks, repeat) for name in engines}
+
+
+def compare_lemmatizers(questions, top_n, engine="tfidf", repeat=10):
+    """Compares latency of the dictionary lemmatizer with classla, and how much its lemmas and results agree.
+
+    Agreement of lemmas is the mean Jaccard similarity of the lemma sets of each question, agreement
+    of results is the mean share of the top n documents found with classla lemmas that are found with
+    dictionary lemmas as well.
+    """
+    queries = [question for question, _ in questions]
+    embedding_manager = get_embedding_manager()
+    dictionary = embedding_manager.get_lemma_dictionary()
+
+    results = {
+        "dictionary_available": dictionary is not None,
+        "latency_ms": {
+            name: time_calls(lambda q: lemmatize_many([q], name), queries, repeat)["latency_ms"]
+            for name in ("classla", "dictionary")
+        },
+    }
+    if dictionary is None:
+        return results
+
+    words = [word for query in queries for word in WORD_PATTERN.findall(query.lower())]
+    results["dictionary_coverage"] = sum(dictionary.lookup(word) is not None for word in words) / len(words)
+
+    classla_lemmas = lemmatize_many(queries, "classla")
+    dictionary_lemmas = lemmatize_many(queries, "dictionary")
+    results["lemma_agreement"] = float(np.mean([
+        len(set(a.split()) & set(b.split())) / max(len(set(a.split()) | set(b.split())), 1)
+        for a, b in zip(classla_lemmas, dictionary_lemmas)
+    ]))
+
+    vectorizer = embedding_manager.get_vectorizer()
+    search_engine = embedding_manager.get_search_engine(engine)
+    classla_top_k = search_engine.search_many(vectorizer.transform(classla_lemmas), top_n)
+    dictionary_top_k = search_engine.search_many(vectorizer.transform(dictionary_lemmas), top_n)
+    results["result_agreement"] = float(np.mean([
+        len(set(a.tolist()) & set(b.tolist())) / max(len(a), 1)
+        for (a, _), (b, _) in zip(classla_top_k, dictionary_top_k)
+    ]))
+    return results
+
+
+def measure_memory(questions, top_n, engine, granularity):
+    """Returns peak memory of searching all questions one by one and in a batch, traced with tracemalloc.
+
+    Memory is measured in its own pass, since tracing allocations slows down every call and would distort
+    latencies measured in the same pass.
+    """
+    queries = [question for question, _ in questions]
+    search_cache.clear()
+    tracemalloc.start()
+    for query in queries:
+        search_documents(query, top_n, engine, granularity)
+    search_cache.clear()
+    search_documents_many(queries, top_n, engine, granularity)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "peak_traced_mb": peak / 2 ** 20,
+        # Maximum resident set size is reported in kilobytes on Linux
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+    }
+
+
+def run_benchmark(engines, ks, repeat=10, engine="tfidf", granularity="documents"):
+    """Runs the whole benchmark and returns its results as a JSON serializable dict."""
+    questions = load_questions()
+
+    start = time.perf_counter()
+    get_embedding_manager(granularity).load_embeddings()
+    load_time = time.perf_counter() - start
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "questions": len(questions),
+        "engine": engine,
+        "granularity": granularity,
+        "index_version": get_embedding_manager(granularity).get_index_version(),
+        "index_load_ms": load_time * 1000,
+        "stages": benchmark_stages(questions, max(ks), engine, granularity, repeat),
+        "recall": evaluate_recall(questions, ks, engine, granularity),
+        "engines": compare_engines(questions, engines, ks, repeat),
+        "lemmatizers": compare_lemmatizers(questions, max(ks), engine, repeat),
+        "memory": measure_memory(questions, max(ks), engine, granularity),
+    }
+    return results
+
+
+def print_results(results, ks):
+    print(f"\nIndex loaded in {results['index_load_ms']:.2f} ms (version {results['index_version']})")
+
+    print(f"\n{'stage':<24}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'q/s':>12}")
+    for stage, result in results["stages"].items():
+        latencies = "".join(f"{value:>10.3f}" for value in result["latency_ms"].values()) if "latency_ms" in result \
+            else " " * 40
+        print(f"{stage:<24}{latencies}{result['throughput_qps']:>12.1f}")
+
+    print(f"\nRecall of {results['engine']} ({results['granularity']}): "
+          + ", ".join(f"R@{k} {recall:.3f}" for k, recall in results["recall"].items()))
+
+    columns = [f"R@{k}" for k in ks] + ["mean ms", "p50 ms", "p95 ms", "p99 ms"]
+    print(f"\n{'engine':<10}" + "".join(f"{column:>10}" for column in columns))
+    for name, result in results["engines"].items():
+        values = [result["recall"][k] for k in ks] + list(result["latency_ms"].values())
+        print(f"{name:<10}" + "".join(f"{value:>10.3f}" for value in values))
+
+    lemmatizers = results["lemmatizers"]
+    print(f"\n{'lemmatizer':<12}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, latencies in lemmatizers["latency_ms"].items():
+        print(f"{name:<12}" + "".join(f"{value:>10.3f}" for value in latencies.values()))
+    if lemmatizers["dictionary_available"]:
+        print(f"Dictionary covers {lemmatizers['dictionary_coverage']:.1%} of query words, "
+              f"lemma agreement {lemmatizers['lemma_agreement']:.3f}, "
+              f"result agreement {lemmatizers['result_agreement']:.3f}")
+    else:
+        print("Index contains no word form table, the dictionary lemmatizer falls back to classla")
+
+    print(f"\nPeak traced memory {results['memory']['peak_traced_mb']:.1f} MB, "
+          f"max RSS {results['memory']['max_rss_mb']:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks latency, throughput, memory and recall of retrieval.")
+    parser.add_argument("--engines", nargs="+", default=["tfidf", "bm25", "fusion", "lsa"],
+                        help="search engines to compare")
+    parser.add_argument("--engine", default="tfidf", help="search engine used for the stage benchmark")
+    parser.add_argument("--granularity", default="documents", help="documents, chunks or parents")
+    parser.add_argument("--k", nargs="+", type=int, default=[1, 3, 5, 10], help="cut-offs for recall@k")
+    parser.add_argument("--repeat", type=int, default=10, help="number of times each question is searched")
+    parser.add_argument("--output", help="path of a JSON file the results are written to")
+    args = parser.parse_args()
+
+    print(f"Benchmarking on {len(load_questions())} questions...")
+    benchmark_results = run_benchmark(args.engines, args.k, args.repeat, args.engine, args.granularity)
+    print_results(benchmark_results, args.k)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(benchmark_results, f, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,108 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """Thread-safe bounded LRU cache, optionally persisted to a SQLite file.
+
+    Values must be JSON serializable when the cache is persisted. Access times of persisted entries served from
+    the cache are written in batches, so the persisted cache is trimmed by last use as well.
+    """
+
+    # Number of served entries whose access times are buffered before they are written
+    ACCESS_BATCH_SIZE = 100
+
+    def __init__(self, max_size, path=None, table="cache"):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+        self._table = table
+        self._conn = None
+        self._puts = 0
+        self._accessed = {}
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, accessed_at REAL)"
+            )
+            self._conn.commit()
+
+    def get(self, key):
+        """Returns cached value or None if the key is not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._touch(key)
+                return self._entries[key]
+
+            if self._conn is None:
+                return None
+
+            row = self._conn.execute(f"SELECT value FROM {self._table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            value = json.loads(row[0])
+            self._set(key, value)
+            self._touch(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+            if self._conn is not None:
+                self._conn.execute(
+                    f"INSERT OR REPLACE INTO {self._table} (key, value, accessed_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time())
+                )
+                self._puts += 1
+                # Keep the persisted cache bounded as well, trimming it only every so often
+                if self._puts % 100 == 0:
+                    self._write_access_times()
+                    self._conn.execute(
+                        f"DELETE FROM {self._table} WHERE key NOT IN "
+                        f"(SELECT key FROM {self._table} ORDER BY accessed_at DESC LIMIT ?)",
+                        (self.max_size,)
+                    )
+                self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._accessed.clear()
+            if self._conn is not None:
+                self._conn.execute(f"DELETE FROM {self._table}")
+                self._conn.commit()
+
+    def _touch(self, key):
+        if self._conn is None:
+            return
+        self._accessed[key] = time.time()
+        if len(self._accessed) >= self.ACCESS_BATCH_SIZE:
+            self._write_access_times()
+            self._conn.commit()
+
+    def _write_access_times(self):
+        self._conn.executemany(f"UPDATE {self._table} SET accessed_at = ? WHERE key = ?",
+                               [(accessed_at, key) for key, accessed_at in self._accessed.items()])
+        self._accessed.clear()
+
+    def _set(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def normalize_query(text):
+    """Normalizes query text (whitespace and letter case), so near-repeated queries share a cache entry."""
+    return " ".join(text.split()).casefold()
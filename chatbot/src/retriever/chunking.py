@@ -0,0 +1,92 @@
+import re
+
+# Chunk ids are made of the id of their parent element and the label of the chunk, e.g. art_5#1(a)
+CHUNK_ID_SEPARATOR = "#"
+
+# Numbered paragraphs ("1.   ...") and points ("(a) ...", "(1) ...") start at the beginning of a line
+PARAGRAPH_PATTERN = re.compile(r"^(\d+)\.\s", re.MULTILINE)
+POINT_PATTERN = re.compile(r"^\(([a-z]+|\d+)\)\s", re.MULTILINE)
+
+
+def parent_id(element_id):
+    """Returns id of the element the chunk belongs to, or the id itself if it is not a chunk id."""
+    return element_id.split(CHUNK_ID_SEPARATOR, 1)[0]
+
+
+def next_label(label):
+    """Returns the label that follows the given one in a list, e.g. 2 after 1 and b after a."""
+    if label.isdigit():
+        return str(int(label) + 1)
+    return chr(ord(label) + 1) if len(label) == 1 else None
+
+
+def split_on(pattern, text):
+    """Splits text at matches of the pattern, returns the text before the first match and (label, part) pairs.
+
+    Only matches that continue the sequence of labels (1, 2, 3 or a, b, c) start a new part, other
+    matches belong to a nested list (e.g. (i), (ii) within point (h)) and stay in the current part.
+    """
+    candidates = list(pattern.finditer(text))
+    matches = []
+    for i, match in enumerate(candidates):
+        label = match.group(1)
+        # (i) followed by (ii) starts a nested list of roman numerals, not the point after (h)
+        if label == "i" and i + 1 < len(candidates) and candidates[i + 1].group(1) == "ii":
+            continue
+        if (not matches and label in ("1", "a")) or (matches and label == next_label(matches[-1].group(1))):
+            matches.append(match)
+    if not matches:
+        return text.strip(), []
+    parts = [
+        (match.group(1), text[match.start():next_match.start() if next_match else len(text)].strip())
+        for match, next_match in zip(matches, matches[1:] + [None])
+    ]
+    return text[:matches[0].start()].strip(), parts
+
+
+def split_article(content, max_chars=1500):
+    """Splits the content of an article into (label, text) chunks.
+
+    Articles are split into numbered paragraphs, or into points if they have no numbered paragraphs.
+    Paragraphs longer than max_chars are split further into their points, each preceded by the
+    lead-in sentence of the paragraph, so it can be understood on its own.
+    """
+    lead_in, paragraphs = split_on(PARAGRAPH_PATTERN, content)
+    if not paragraphs:
+        lead_in, points = split_on(POINT_PATTERN, content)
+        if not points:
+            return [("0", content.strip())]
+        return [(f"({label})", f"{lead_in}\n{point}".strip()) for label, point in points]
+
+    # Text before the first paragraph is labeled 0, paragraphs are numbered from 1
+    chunks = [("0", lead_in)] if lead_in else []
+    for label, paragraph in paragraphs:
+        paragraph_lead_in, points = split_on(POINT_PATTERN, paragraph)
+        if len(paragraph) <= max_chars or not points:
+            chunks.append((label, paragraph))
+        else:
+            chunks += [(f"{label}({point_label})", f"{paragraph_lead_in}\n{point}") for point_label, point in points]
+    return chunks
+
+
+def position(element, key):
+    """Returns chapter, section and article number of an article, by which searches can be filtered."""
+    if key != "cleni":
+        return {}
+    return {"chapter": element['poglavje']['id_elementa'],
+            "section": element['oddelek']['id_elementa'] if element['oddelek'] else None,
+            "article": element['clen']}
+
+
+def chunk_element(d, key, max_chars=1500):
+    """Returns metadata of chunks of an element of either 'cleni' or 'tocke', each with the id of the element.
+
+    Recitals ('tocke') are short, so each of them is a single chunk with the id of the recital.
+    """
+    if key != "cleni":
+        return [{"id": d['id_elementa'], "type": key, "raw_text": d['vsebina'], "parent": d['id_elementa']}]
+    heading = d['naslov']
+    return [{"id": f"{d['id_elementa']}{CHUNK_ID_SEPARATOR}{label}", "type": key, "raw_text": f"{heading}\n{text}",
+             "parent": d['id_elementa'], **position(d, key)}
+            for label, text in split_article(d['vsebina'], max_chars)]
+
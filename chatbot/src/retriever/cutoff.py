@@ -0,0 +1,47 @@
+from typing import List
+
+from langchain_core.documents import Document
+
+
+def adaptive_cutoff(scores, min_score=None, min_ratio=0.0, max_gap=1.0, min_documents=1):
+    """Returns how many of the ranked scores to keep and the reason for the cut-off.
+
+    The ranking is cut before the first document whose score is below min_score, below min_ratio of
+    the top score, or lower than the score of the previous document by more than max_gap of the top score.
+    At least min_documents are kept (if there are as many). Ratios and gaps are relative to the top score,
+    so they apply to every engine, while min_score depends on the scale of scores of the engine.
+    """
+    if len(scores) == 0:
+        return 0, {"reason": "none", "detail": "no documents were found"}
+    top = float(scores[0])
+    for i in range(max(min_documents, 1), len(scores)):
+        score = float(scores[i])
+        if min_score is not None and score < min_score:
+            return i, {"reason": "min_score", "detail": f"score {score:.4f} of document {i + 1} is below {min_score}"}
+        if top > 0 and score / top < min_ratio:
+            return i, {"reason": "ratio", "detail": f"score {score:.4f} of document {i + 1} is {score / top:.2f} "
+                                                    f"of the top score {top:.4f}, below {min_ratio}"}
+        gap = float(scores[i - 1]) - score
+        if top > 0 and gap / top > max_gap:
+            return i, {"reason": "gap", "detail": f"score of document {i + 1} drops by {gap / top:.2f} of the "
+                                                  f"top score, more than {max_gap}"}
+    # Fewer than k documents may have been found, all of them are kept
+    return len(scores), {"reason": "all_found",
+                         "detail": f"all {len(scores)} found documents are within the thresholds"}
+
+
+def cut_documents(documents: List[Document], min_score=None, min_ratio=0.0, max_gap=1.0,
+                  min_documents=1) -> List[Document]:
+    """Keeps the documents before the adaptive cut-off of their similarity scores.
+
+    Each kept document gets the reasoning in its "cutoff" metadata: the number of kept and found
+    documents, the reason for the cut-off (min_score, ratio, gap, or all_found if all found documents are kept) and
+    a description of it.
+    """
+    kept, reasoning = adaptive_cutoff([document.metadata["similarity_score"] for document in documents],
+                                      min_score, min_ratio, max_gap, min_documents)
+    cutoff = {"kept": kept, "candidates": len(documents), **reasoning}
+    return [
+        Document(page_content=document.page_content, metadata={**document.metadata, "cutoff": cutoff})
+        for document in documents[:kept]
+    ]
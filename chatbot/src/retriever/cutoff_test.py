@@ -0,0 +1,34 @@
+import pytest
+
+from src.retriever.cutoff import adaptive_cutoff
+
+
+@pytest.mark.parametrize("scores, kwargs, kept, reason", [
+    # Empty input
+    ([], {}, 0, "none"),
+    # Absolute minimum score
+    ([0.9, 0.8, 0.04, 0.03], {"min_score": 0.05}, 2, "min_score"),
+    # Share of the top score
+    ([1.0, 0.9, 0.4, 0.39], {"min_ratio": 0.5}, 2, "ratio"),
+    # Drop between consecutive scores, relative to the top score
+    ([1.0, 0.95, 0.9, 0.5, 0.45], {"max_gap": 0.25}, 3, "gap"),
+    # All found documents are kept, also when fewer than k were found
+    ([1.0, 0.9, 0.8], {"min_score": 0.05, "min_ratio": 0.5, "max_gap": 0.25}, 3, "all_found"),
+    ([0.7], {"min_score": 0.05}, 1, "all_found"),
+    # Documents below the floor of min_documents are kept regardless of their scores
+    ([0.9, 0.01, 0.005, 0.001], {"min_score": 0.05, "min_documents": 3}, 3, "min_score"),
+    ([0.9, 0.01], {"min_score": 0.05, "min_documents": 3}, 2, "all_found"),
+    # The top document is always kept
+    ([0.01, 0.005], {"min_score": 0.05, "min_documents": 0}, 1, "min_score"),
+])
+def test_adaptive_cutoff(scores, kwargs, kept, reason):
+    n, reasoning = adaptive_cutoff(scores, **kwargs)
+    assert n == kept
+    assert reasoning["reason"] == reason
+    assert reasoning["detail"]
+
+
+def test_first_violated_threshold_is_reported():
+    # The third score is both below min_score and below min_ratio, min_score is checked first
+    n, reasoning = adaptive_cutoff([1.0, 0.9, 0.01], min_score=0.05, min_ratio=0.5)
+    assert (n, reasoning["reason"]) == (2, "min_score")
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from src.retriever.index_file import write_array_file, map_array_file, encode_fixed_width, Strings
+from src.retriever.ingest import iter_elements, TextSpool
+
+# Layout of a document store file is the one of index files, with its own magic and format version
+MAGIC = b"AIACTDOC"
+FORMAT_VERSION = 1
+
+
+def file_checksum(path):
+    """Returns SHA-256 of the contents of the file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def compile_document_store(source_path, path, checksum=None):
+    """Compiles elements of a corpus source file (YAML or JSON Lines) into a memory-mappable document store.
+
+    Elements are streamed from the source and their JSON encodings spooled to a file, so compiling
+    holds only their ids in memory. The checksum of the source is stored, see DocumentStore.is_compiled_from.
+    Processes may compile the same store at once, each spools to its own file and the last written store wins.
+    """
+    ids, keys = [], []
+    elements = TextSpool(path.with_name(f"{path.name}.{os.getpid()}.elements"))
+    try:
+        for key, element in iter_elements(source_path):
+            ids.append(element["id_elementa"])
+            keys.append(key)
+            elements.append([json.dumps(element, ensure_ascii=False)])
+
+        arrays = {"ids": encode_fixed_width(ids), "keys": encode_fixed_width(keys)}
+        arrays["elements_blob"], arrays["elements_offsets"] = elements.arrays()
+        # Ids in sorted order, in which they are looked up with binary search, and their rows
+        arrays["id_order"] = np.argsort(arrays["ids"], kind="stable").astype(np.int64)
+        arrays["sorted_ids"] = arrays["ids"][arrays["id_order"]]
+        write_array_file(path, MAGIC, FORMAT_VERSION,
+                         {"source_checksum": checksum or file_checksum(source_path), "n_elements": len(ids)}, arrays)
+    finally:
+        elements.close()
+
+
+class DocumentStore:
+    """Read-only store of the elements of a corpus (articles and recitals with their structure and texts).
+
+    Elements are stored as JSON in a memory-mapped file and decoded only when they are accessed, so the
+    store opens in the same time regardless of its size and its pages are shared by all processes.
+    """
+
+    def __init__(self, path):
+        self.header, arrays = map_array_file(path, MAGIC, FORMAT_VERSION)
+        self.ids = arrays["ids"]
+        self.keys = arrays["keys"]
+        self.elements = Strings(arrays["elements_blob"], arrays["elements_offsets"])
+        self.id_order = arrays["id_order"]
+        self.sorted_ids = arrays["sorted_ids"]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def is_compiled_from(self, checksum):
+        return self.header["source_checksum"] == checksum
+
+    def get(self, element_id):
+        """Returns the element with the given id, or None if there is no such element."""
+        encoded = element_id.encode("utf-8")
+        i = np.searchsorted(self.sorted_ids, encoded)
+        if i == len(self.sorted_ids) or self.sorted_ids[i] != encoded:
+            return None
+        return json.loads(self.elements[self.id_order[i]])
+
+    def iter_elements(self):
+        """Yields (key, element) pairs of all elements, in the order of the source file."""
+        for i in range(len(self)):
+            yield self.keys[i].decode("utf-8"), json.loads(self.elements[i])
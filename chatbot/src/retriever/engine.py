@@ -0,0 +1,339 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+
+
+class SparseTopKEngine:
+    """Top-k search over L2-normalized TF-IDF rows using an inverted index.
+
+    Rows of the TF-IDF matrix (and query vectors) are already L2-normalized by the vectorizer,
+    so cosine similarity reduces to a dot product. Only postings of the query terms are scored,
+    which makes the cost of a search depend on the query length instead of the corpus size.
+
+    With binary_queries set, each query term contributes its posting weight as is, regardless of
+    its weight in the query vector. This is used for BM25, whose weights are precomputed per posting.
+    """
+
+    def __init__(self, postings_ptr, postings_docs, postings_weights, n_documents, binary_queries=False):
+        self.n_documents = n_documents
+        self.binary_queries = binary_queries
+
+        # Inverted index: postings of term t are postings_docs[postings_ptr[t]:postings_ptr[t + 1]]
+        self.postings_ptr = postings_ptr
+        self.postings_docs = postings_docs
+        self.postings_weights = postings_weights
+
+        # The same postings viewed as a (terms x documents) matrix, used for scoring query batches
+        self.postings_matrix = csr_matrix(
+            (self.postings_weights, self.postings_docs, self.postings_ptr),
+            shape=(len(postings_ptr) - 1, self.n_documents)
+        )
+
+    @classmethod
+    def from_matrix(cls, tfidf_matrix):
+        """Builds the engine from a (documents x terms) TF-IDF matrix."""
+        postings = tfidf_matrix.tocsc().astype(np.float32)
+        postings.sort_indices()
+        return cls(postings.indptr, postings.indices, postings.data, tfidf_matrix.shape[0])
+
+    def score(self, query_vector, starts=None, ends=None):
+        """Returns ids and scores of all documents that share at least one term with the query.
+
+        Only postings between per-term starts and ends offsets are scored if they are given, by default
+        all postings of the terms are.
+        """
+        terms = query_vector.indices
+        weights = np.ones(len(terms), dtype=np.float32) if self.binary_queries else query_vector.data.astype(np.float32)
+        if len(terms) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        if starts is None:
+            starts, ends = self.postings_ptr[:-1], self.postings_ptr[1:]
+        starts, lengths = starts[terms], ends[terms] - starts[terms]
+
+        # Gather postings of all query terms at once
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        docs = self.postings_docs[offsets]
+        contributions = self.postings_weights[offsets] * np.repeat(weights, lengths)
+
+        # Accumulate contributions per candidate document
+        candidates, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions).astype(np.float32)
+
+        nonzero = scores > 0
+        return candidates[nonzero], scores[nonzero]
+
+    def search(self, query_vector, top_n=None):
+        """Returns ids and scores of the top n documents, ordered by descending score.
+
+        Documents with zero score are skipped. If top_n is None, all matching documents are returned.
+        """
+        candidates, scores = self.score(query_vector)
+        return select_top_n(candidates, scores, top_n)
+
+    def shard_offsets(self, shard_size):
+        """Returns offsets of the first posting of each term in each shard of shard_size rows.
+
+        Row i of the returned (shards + 1 x terms) array holds offsets of shard i, which are also the ends
+        of shard i - 1, the last row holds the ends of the postings. Postings of all shards are counted
+        per (term, shard) in a single pass.
+        """
+        n_terms = len(self.postings_ptr) - 1
+        n_shards = -(-self.n_documents // shard_size)
+        terms = np.repeat(np.arange(n_terms, dtype=np.int64), np.diff(self.postings_ptr))
+        counts = np.bincount(terms * n_shards + self.postings_docs // shard_size, minlength=n_terms * n_shards)
+
+        offsets = np.empty((n_shards + 1, n_terms), dtype=np.int64)
+        offsets[0] = self.postings_ptr[:-1]
+        np.cumsum(counts.reshape(n_terms, n_shards).T, axis=0, out=offsets[1:])
+        offsets[1:] += offsets[0]
+        return offsets
+
+    def shards(self, shard_size):
+        """Returns engines over consecutive shards of shard_size rows, which share the postings of this engine."""
+        # The ends of each shard are the same array as the starts of the next one
+        offsets = list(self.shard_offsets(shard_size))
+        return [
+            SparseRangeEngine(self, start, min(start + shard_size, self.n_documents), offsets[i], offsets[i + 1])
+            for i, start in enumerate(range(0, self.n_documents, shard_size))
+        ]
+
+    def subset(self, rows):
+        """Returns an engine over the given rows only, which still returns rows of the whole index."""
+        postings = self.postings_matrix[:, rows].tocsr()
+        postings.sort_indices()
+        return RowSubsetEngine(
+            SparseTopKEngine(postings.indptr, postings.indices, postings.data, len(rows), self.binary_queries), rows
+        )
+
+    def search_many(self, query_matrix, top_n=None):
+        """Searches a batch of query vectors (one per row) with a single sparse matrix product."""
+        query_matrix = query_matrix.astype(np.float32)
+        if self.binary_queries:
+            query_matrix.data[:] = 1
+        scores = (query_matrix @ self.postings_matrix).tocsr()
+        scores.sort_indices()
+
+        results = []
+        for i in range(scores.shape[0]):
+            row = slice(scores.indptr[i], scores.indptr[i + 1])
+            candidates, row_scores = scores.indices[row], scores.data[row]
+            nonzero = row_scores > 0
+            results.append(select_top_n(candidates[nonzero], row_scores[nonzero], top_n))
+        return results
+
+
+class SparseRangeEngine:
+    """Engine over a contiguous range of rows of a sparse engine, e.g. a shard of the index.
+
+    Postings of each term are sorted by document, so postings of the range are a slice of the postings
+    of each term, given by its starts and ends offsets. Only these offsets are stored, the postings themselves
+    stay shared with the engine (and mapped from the index file), and returned ids are rows of the whole index.
+    """
+
+    def __init__(self, engine, start, stop, starts, ends):
+        self.n_documents = stop - start
+        self.engine = engine
+        self.starts = starts
+        self.ends = ends
+
+    def search(self, query_vector, top_n=None):
+        """Returns ids and scores of the top n documents of the range, ordered by descending score."""
+        candidates, scores = self.engine.score(query_vector, self.starts, self.ends)
+        return select_top_n(candidates, scores, top_n)
+
+    def search_many(self, query_matrix, top_n=None):
+        """Searches query vectors one by one, as postings of the range are not a matrix of their own."""
+        query_matrix = query_matrix.tocsr()
+        return [self.search(query_matrix[i], top_n) for i in range(query_matrix.shape[0])]
+
+
+class DenseTopKEngine:
+    """Brute-force top-k search over dense, L2-normalized LSA document vectors.
+
+    Query TF-IDF vectors are projected onto the LSA components and normalized, so cosine similarity
+    again reduces to a dot product. Unlike term matching, documents that share no term with the
+    query can still be found, if they use related terms.
+    """
+
+    def __init__(self, document_vectors, components):
+        self.n_documents = document_vectors.shape[0]
+        self.document_vectors = document_vectors
+        self.components = components
+
+    def project(self, query_matrix):
+        """Projects TF-IDF query vectors (one per row) into the normalized LSA space."""
+        return normalize(query_matrix.astype(np.float32) @ self.components.T)
+
+    def search(self, query_vector, top_n=None):
+        """Returns ids and scores of the top n documents, ordered by descending score."""
+        return self.search_many(query_vector, top_n)[0]
+
+    def subset(self, rows):
+        """Returns an engine over the given rows only, which still returns rows of the whole index."""
+        if len(rows) > 0 and rows[-1] - rows[0] + 1 == len(rows):
+            # Contiguous rows (e.g. a shard) are a view of the vectors, not a copy
+            document_vectors = self.document_vectors[rows[0]:rows[-1] + 1]
+        else:
+            document_vectors = np.ascontiguousarray(self.document_vectors[rows])
+        return RowSubsetEngine(DenseTopKEngine(document_vectors, self.components), rows)
+
+    def shards(self, shard_size):
+        """Returns engines over consecutive shards of shard_size rows, whose vectors are views of these vectors."""
+        return [self.subset(np.arange(start, min(start + shard_size, self.n_documents)))
+                for start in range(0, self.n_documents, shard_size)]
+
+    def search_many(self, query_matrix, top_n=None):
+        """Searches a batch of query vectors (one per row) with a single dense matrix product."""
+        scores = self.project(query_matrix) @ self.document_vectors.T
+
+        results = []
+        for row_scores in scores:
+            candidates = np.flatnonzero(row_scores > 0)
+            results.append(select_top_n(candidates, row_scores[candidates], top_n))
+        return results
+
+
+class FusionEngine:
+    """Reciprocal-rank fusion of the rankings of several engines.
+
+    Each engine ranks its top depth documents, a document then scores sum(1 / (k + rank)) over
+    the rankings it appears in. Scores are therefore not similarities, only their order is meaningful.
+    """
+
+    def __init__(self, engines, k=60, depth=100):
+        self.n_documents = engines[0].n_documents
+        self.engines = engines
+        self.k = k
+        self.depth = depth
+
+    def search(self, query_vector, top_n=None):
+        """Returns ids and fused scores of the top n documents, ordered by descending score."""
+        return self.search_many(query_vector, top_n)[0]
+
+    def subset(self, rows):
+        """Returns fusion of the engines restricted to the given rows."""
+        return FusionEngine([engine.subset(rows) for engine in self.engines], self.k, self.depth)
+
+    def search_many(self, query_matrix, top_n=None):
+        """Searches a batch of query vectors (one per row) with one batched search of each engine."""
+        rankings = [engine.search_many(query_matrix, self.depth) for engine in self.engines]
+        return [
+            self.fuse([ranking[i][0] for ranking in rankings], top_n)
+            for i in range(query_matrix.shape[0])
+        ]
+
+    def fuse(self, ranked_documents, top_n=None):
+        documents = np.concatenate(ranked_documents).astype(np.int64)
+        ranks = np.concatenate([np.arange(1, len(ranked) + 1) for ranked in ranked_documents])
+
+        candidates, inverse = np.unique(documents, return_inverse=True)
+        scores = np.bincount(inverse, weights=1 / (self.k + ranks), minlength=len(candidates)).astype(np.float32)
+        return select_top_n(candidates, scores, top_n)
+
+
+class RowSubsetEngine:
+    """Engine over a subset of rows of the index, e.g. the documents that satisfy search filters.
+
+    The wrapped engine only holds the subset, so filtered searches score fewer documents than
+    unfiltered ones, and its results are mapped back to rows of the whole index.
+    """
+
+    def __init__(self, engine, rows):
+        self.n_documents = len(rows)
+        self.engine = engine
+        self.rows = rows
+
+    def search(self, query_vector, top_n=None):
+        candidates, scores = self.engine.search(query_vector, top_n)
+        return self.rows[candidates], scores
+
+    def search_many(self, query_matrix, top_n=None):
+        return [(self.rows[candidates], scores) for candidates, scores in self.engine.search_many(query_matrix, top_n)]
+
+
+class ShardedEngine:
+    """Engine whose documents are split into shards of contiguous rows, which are searched in parallel.
+
+    Each shard returns its own top n documents, which are merged into the top n of the whole index.
+    Scoring kernels of NumPy, SciPy and BLAS release the GIL, so threads of the executor search
+    shards on multiple cores. Shards share the arrays of the engine, so sharding does not copy the index.
+    """
+
+    def __init__(self, engine, shard_size, executor):
+        self.n_documents = engine.n_documents
+        self.engine = engine
+        self.executor = executor
+        self.shards = engine.shards(shard_size)
+
+    def subset(self, rows):
+        """Returns an engine over the given rows only, which is not sharded, since filters select few rows."""
+        return self.engine.subset(rows)
+
+    def search(self, query_vector, top_n=None):
+        """Returns ids and scores of the top n documents, ordered by descending score."""
+        return merge_top_n(list(self.executor.map(lambda shard: shard.search(query_vector, top_n), self.shards)),
+                           top_n)
+
+    def search_many(self, query_matrix, top_n=None):
+        """Searches a batch of query vectors (one per row), each shard with a single batched search."""
+        results = list(self.executor.map(lambda shard: shard.search_many(query_matrix, top_n), self.shards))
+        return [merge_top_n([shard_results[i] for shard_results in results], top_n)
+                for i in range(query_matrix.shape[0])]
+
+
+def fit_bm25(term_counts, k1=1.2, b=0.75):
+    """Computes BM25 weights of all (document, term) pairs of the term count matrix.
+
+    Returns the weights as an inverted index (arrays to be stored in the index), so BM25 scores of a query
+    are sums of the postings of its terms.
+    """
+    counts = csr_matrix(term_counts, dtype=np.float32, copy=True)
+    n_documents = counts.shape[0]
+
+    document_lengths = np.asarray(counts.sum(axis=1)).ravel()
+    average_length = document_lengths.mean()
+    document_frequencies = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log(1 + (n_documents - document_frequencies + 0.5) / (document_frequencies + 0.5))
+
+    # Length normalization of every stored term count, by the length of its document
+    lengths = np.repeat(document_lengths, np.diff(counts.indptr))
+    tf = counts.data
+    counts.data = (idf[counts.indices] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths / average_length))).astype(np.float32)
+
+    postings = counts.tocsc()
+    postings.sort_indices()
+    return {
+        "bm25_weights": postings.data,
+        "bm25_docs": postings.indices,
+        "bm25_ptr": postings.indptr,
+    }
+
+
+def fit_lsa(tfidf_matrix, n_components):
+    """Fits truncated SVD of the TF-IDF matrix and returns the arrays of the LSA engine to be stored in the index."""
+    # Number of components is bounded by the size of the matrix
+    svd = TruncatedSVD(n_components=min(n_components, min(tfidf_matrix.shape) - 1), random_state=0)
+    document_vectors = normalize(svd.fit_transform(tfidf_matrix))
+    return {
+        "lsa_vectors": document_vectors.astype(np.float32),
+        "lsa_components": svd.components_.astype(np.float32),
+    }
+
+
+def merge_top_n(results, top_n=None):
+    """Merges (ids, scores) results of several engines over disjoint documents into the overall top n."""
+    return select_top_n(np.concatenate([ids.astype(np.int64) for ids, _ in results]),
+                        np.concatenate([scores for _, scores in results]), top_n)
+
+
+def select_top_n(candidates, scores, top_n=None):
+    """Orders candidates by descending score, keeping only the top n of them."""
+    if top_n is not None and top_n < len(scores):
+        # Partial selection of the top n candidates, only these get sorted
+        selected = np.argpartition(-scores, top_n - 1)[:top_n]
+        candidates, scores = candidates[selected], scores[selected]
+
+    order = np.argsort(-scores, kind="stable")
+    return candidates[order], scores[order]
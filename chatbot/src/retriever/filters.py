@@ -0,0 +1,62 @@
+import numpy as np
+
+# Filters restrict the search to documents of the given types ('cleni', 'tocke'), chapters (e.g. cpt_III),
+# sections (e.g. cpt_III.sct_1) and an inclusive range of article numbers, e.g.
+# {"types": ["cleni"], "chapters": ["cpt_III"], "articles": (6, 15)}
+FILTER_NAMES = ("types", "chapters", "sections", "articles")
+
+
+class InvalidFilterError(ValueError):
+    """Raised for search filters given by the caller that are not valid, unlike errors of the index itself."""
+
+
+def validate_filters(filters):
+    unknown = set(filters) - set(FILTER_NAMES)
+    if unknown:
+        raise InvalidFilterError(f"Unknown search filters: {', '.join(sorted(unknown))}")
+    for name in ("types", "chapters", "sections"):
+        values = filters.get(name)
+        if values is not None and (not isinstance(values, (list, tuple)) or
+                                   not all(isinstance(value, str) for value in values)):
+            raise InvalidFilterError(f"Filter {name} must be a list of strings")
+    articles = filters.get("articles")
+    if articles is not None:
+        try:
+            valid = len(articles) == 2 and all(int(article) == article for article in articles)
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            raise InvalidFilterError("Filter articles must be a (first, last) range of article numbers")
+
+
+def filter_key(filters):
+    """Returns canonical representation of the filters, used in cache keys, or an empty string without filters."""
+    if not filters:
+        return ""
+    validate_filters(filters)
+    parts = []
+    for name in FILTER_NAMES:
+        values = filters.get(name)
+        if values is None:
+            continue
+        # Order of allowed values does not matter, order of the range bounds does
+        values = [int(v) for v in values] if name == "articles" else sorted(values)
+        parts.append(f"{name}={','.join(map(str, values))}")
+    return ";".join(parts)
+
+
+def filter_rows(metadata, filters):
+    """Returns sorted rows of the documents that satisfy all of the filters."""
+    validate_filters(filters)
+    mask = np.ones(len(metadata), dtype=bool)
+    if filters.get("types") is not None:
+        mask &= np.isin(metadata.types, [t.encode("utf-8") for t in filters["types"]])
+    if filters.get("chapters") is not None:
+        mask &= np.isin(metadata.get_column("chapters"), [c.encode("utf-8") for c in filters["chapters"]])
+    if filters.get("sections") is not None:
+        mask &= np.isin(metadata.get_column("sections"), [s.encode("utf-8") for s in filters["sections"]])
+    if filters.get("articles") is not None:
+        first, last = filters["articles"]
+        articles = metadata.get_column("articles")
+        mask &= (articles >= first) & (articles <= last)
+    return np.flatnonzero(mask)
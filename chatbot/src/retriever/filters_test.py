@@ -0,0 +1,35 @@
+import pytest
+
+from src.retriever.filters import InvalidFilterError, validate_filters, filter_key
+
+
+@pytest.mark.parametrize("filters", [
+    {"types": ["cleni"], "chapters": ["cpt_III"], "sections": ["cpt_III.sct_1"], "articles": (6, 15)},
+    {"types": ("cleni", "tocke"), "articles": [6, 15]},
+    {"chapters": None},
+    {},
+])
+def test_valid_filters(filters):
+    validate_filters(filters)
+
+
+@pytest.mark.parametrize("filters", [
+    {"types": "cleni"},  # a single value instead of a list
+    {"chapters": 5},
+    {"sections": {"cpt_III.sct_1": True}},
+    {"types": [1]},  # members that are not strings
+    {"chapters": ["cpt_III", None]},
+    {"articles": (6,)},
+    {"articles": ("6", "15")},
+    {"articles": 6},
+    {"paragraphs": ["1"]},
+])
+def test_invalid_filters(filters):
+    with pytest.raises(InvalidFilterError):
+        validate_filters(filters)
+
+
+def test_filter_key_does_not_depend_on_order_of_values():
+    assert filter_key({"types": ["tocke", "cleni"], "articles": (6, 15)}) == \
+           filter_key({"articles": [6, 15], "types": ["cleni", "tocke"]}) == "types=cleni,tocke;articles=6,15"
+    assert filter_key(None) == ""
@@ -0,0 +1,360 @@
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+from bisect import bisect_left
+from collections import Counter
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
+
+# Layout of an index file: magic, format version and header length, followed by a JSON header and
+# raw arrays, each starting at a page-aligned offset so it can be mapped into memory as it is
+MAGIC = b"AIACTIDX"
+FORMAT_VERSION = 2
+PREFIX = struct.Struct("<8sII")
+ALIGNMENT = mmap.ALLOCATIONGRANULARITY
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def encode_strings(strings):
+    """Encodes strings into one contiguous UTF-8 blob and offsets of each string in it."""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def decode_string(blob, offsets, i):
+    return bytes(blob[offsets[i]:offsets[i + 1]]).decode("utf-8")
+
+
+def encode_fixed_width(strings):
+    """Encodes strings into a fixed-width byte string array, as wide as the longest UTF-8 encoded string."""
+    return np.array([s.encode("utf-8") for s in strings], dtype=np.bytes_)
+
+
+def encode_lemma_dictionary(dictionary):
+    """Encodes a word form to lemma dictionary into arrays to be stored in the index, ordered by word form."""
+    forms = sorted(dictionary)
+    arrays = {}
+    arrays["forms_blob"], arrays["forms_offsets"] = encode_strings(forms)
+    arrays["form_lemmas_blob"], arrays["form_lemmas_offsets"] = encode_strings([dictionary[form] for form in forms])
+    return arrays
+
+
+def write_index(path, vectorizer, tfidf_matrix, metadata, version, extra_arrays=None, texts=None):
+    """Writes the fitted vectorizer, TF-IDF matrix and document metadata as a memory-mappable index file.
+
+    Arrays of optional engines (e.g. LSA vectors) are passed in extra_arrays, keyed on their name.
+    Texts of the documents are taken from raw_text of their metadata, unless their (blob, offsets) are passed
+    in texts, e.g. texts spooled to a file while the corpus was read.
+
+    """
+    params = vectorizer.get_params()
+    if params["analyzer"] != "word" or params["ngram_range"] != (1, 1) or params["tokenizer"] is not None \
+            or params["preprocessor"] is not None or params["strip_accents"] is not None \
+            or params["stop_words"] is not None or params["binary"]:
+        raise ValueError("Only word unigram vectorizers with the default preprocessing can be stored in an index file")
+
+    terms = vectorizer.get_feature_names_out().tolist()
+    # Terms are looked up with binary search, which relies on columns being ordered by term
+    if any(a >= b for a, b in zip(terms, terms[1:])):
+        raise ValueError("Vocabulary of the vectorizer is not sorted")
+
+    # Copied, so sorting indices does not modify the matrix of the caller
+    matrix = csr_matrix(tfidf_matrix, dtype=np.float32, copy=True)
+    matrix.sort_indices()
+    # Inverted index of the same matrix, so the search engine does not have to build it on load
+    postings = matrix.tocsc()
+    postings.sort_indices()
+
+    arrays = {
+        "data": matrix.data,
+        "indices": matrix.indices,
+        "indptr": matrix.indptr,
+        "postings_weights": postings.data,
+        "postings_docs": postings.indices,
+        "postings_ptr": postings.indptr,
+        "idf": np.asarray(vectorizer.idf_, dtype=np.float32),
+    }
+    arrays["terms_blob"], arrays["terms_offsets"] = encode_strings(terms)
+
+    # Short columns are stored as fixed-width arrays, texts in one blob, so no per-document objects are created on load
+    arrays["ids"] = encode_fixed_width([m["id"] for m in metadata])
+    arrays["types"] = encode_fixed_width([m["type"] for m in metadata])
+    arrays["texts_blob"], arrays["texts_offsets"] = texts if texts is not None \
+        else encode_strings([m.get("raw_text", "") for m in metadata])
+    # Chunks refer to the element they were split from
+    if any("parent" in m for m in metadata):
+        arrays["parents"] = encode_fixed_width([m.get("parent", m["id"]) for m in metadata])
+    # Position of articles in the act, used to filter searches. Recitals have no chapter, section or article number
+    if any("chapter" in m for m in metadata):
+        arrays["chapters"] = encode_fixed_width([m.get("chapter") or "" for m in metadata])
+        arrays["sections"] = encode_fixed_width([m.get("section") or "" for m in metadata])
+        arrays["articles"] = np.array([m.get("article") or 0 for m in metadata], dtype=np.int32)
+
+    for name, array in (extra_arrays or {}).items():
+        if name in arrays:
+            raise ValueError(f"Array {name} is already part of the index")
+        arrays[name] = np.ascontiguousarray(array)
+
+    header = {
+        "version": version,
+        "n_documents": matrix.shape[0],
+        "n_terms": matrix.shape[1],
+        "vectorizer": {
+            "lowercase": params["lowercase"],
+            "token_pattern": params["token_pattern"],
+            "norm": params["norm"],
+            "use_idf": params["use_idf"],
+            "sublinear_tf": params["sublinear_tf"],
+        },
+    }
+    write_array_file(path, MAGIC, FORMAT_VERSION, header, arrays)
+
+
+def write_array_file(path, magic, format_version, header, arrays):
+    """Writes the JSON header and the arrays to a file, each array at a page-aligned offset, so it can be mapped.
+
+    The file is written next to the target and moved in place, so readers never see a partially written file.
+    """
+    header = {**header, "arrays": {}}
+    # Offsets of arrays depend on the header length, so the header is laid out with offsets relative to
+    # the end of the header first and moved to absolute offsets once its size is known
+    relative = 0
+    for name, array in arrays.items():
+        relative = align(relative)
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": relative}
+        relative += array.nbytes
+    start = align(PREFIX.size + len(json.dumps(header).encode("utf-8")) + ALIGNMENT)
+    for spec in header["arrays"].values():
+        spec["offset"] += start
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    # Unique per process, so processes writing the same file do not write into each other's temporary file
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(PREFIX.pack(magic, format_version, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(header["arrays"][name]["offset"])
+            # Written straight from the array, so arrays mapped from files are not read into memory at once
+            np.ascontiguousarray(array).tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def map_array_file(path, magic, format_version):
+    """Returns the header and the memory-mapped arrays of a file written by write_array_file."""
+    with open(path, "rb") as f:
+        file_magic, file_format_version, header_length = PREFIX.unpack(f.read(PREFIX.size))
+        if file_magic != magic:
+            raise ValueError(f"{path} is not a {magic.decode()} file")
+        if file_format_version != format_version:
+            raise ValueError(f"Unsupported format version {file_format_version} of {path}")
+        header = json.loads(f.read(header_length))
+
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {
+        name: buffer[spec["offset"]:spec["offset"] + int(np.prod(spec["shape"])) * np.dtype(spec["dtype"]).itemsize]
+        .view(spec["dtype"]).reshape(spec["shape"])
+        for name, spec in header["arrays"].items()
+    }
+    return header, arrays
+
+
+def write_manifest(path, manifest):
+    """Writes the manifest of the index build in use, replacing the previous one atomically."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_manifest(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Missing index manifest {path}. Please run store_embeddings.py first...")
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def prune_builds(builds_dir, keep, current):
+    """Removes all but the keep most recent build directories, never removing the current one."""
+    builds = sorted((d for d in builds_dir.iterdir() if d.is_dir()), key=lambda d: d.stat().st_mtime, reverse=True)
+    for build in builds[keep:]:
+        if build.name != current:
+            # Processes that still map files of the build keep them until they unmap them
+            shutil.rmtree(build, ignore_errors=True)
+
+
+class IndexFile:
+    """Read-only view of an index file, whose arrays are memory mapped instead of read into memory.
+
+    Opening an index only parses its header, so it takes the same time regardless of the index size,
+    and pages of the mapped file are shared by all processes that open it.
+    """
+
+    def __init__(self, path):
+        try:
+            self.header, self.arrays = map_array_file(path, MAGIC, FORMAT_VERSION)
+        except ValueError as e:
+            raise ValueError(f"{e}, please run store_embeddings.py") from e
+
+    @property
+    def version(self):
+        return self.header["version"]
+
+    def has_arrays(self, *names):
+        return all(name in self.arrays for name in names)
+
+    def tfidf_matrix(self):
+        """Returns the TF-IDF matrix as a CSR matrix backed by the mapped arrays."""
+        return csr_matrix((self.arrays["data"], self.arrays["indices"], self.arrays["indptr"]),
+                          shape=(self.header["n_documents"], self.header["n_terms"]), copy=False)
+
+    def postings(self):
+        """Returns (postings_ptr, postings_docs, postings_weights) of the inverted index."""
+        return self.arrays["postings_ptr"], self.arrays["postings_docs"], self.arrays["postings_weights"]
+
+    def bm25(self):
+        """Returns (postings_ptr, postings_docs, postings_weights) of BM25 weights."""
+        if not self.has_arrays("bm25_ptr", "bm25_docs", "bm25_weights"):
+            raise ValueError("Index contains no BM25 weights, please run store_embeddings.py")
+        return self.arrays["bm25_ptr"], self.arrays["bm25_docs"], self.arrays["bm25_weights"]
+
+    def lsa(self):
+        """Returns (document_vectors, components) of the LSA engine."""
+        if not self.has_arrays("lsa_vectors", "lsa_components"):
+            raise ValueError("Index contains no LSA vectors, please run store_embeddings.py with --lsa-components > 0")
+        return self.arrays["lsa_vectors"], self.arrays["lsa_components"]
+
+    def lemma_dictionary(self):
+        """Returns (forms, lemmas) of the word form table, or None if the index contains no table."""
+        if not self.has_arrays("forms_blob", "forms_offsets", "form_lemmas_blob", "form_lemmas_offsets"):
+            return None
+        return (Strings(self.arrays["forms_blob"], self.arrays["forms_offsets"]),
+                Strings(self.arrays["form_lemmas_blob"], self.arrays["form_lemmas_offsets"]))
+
+    def vectorizer(self):
+        return QueryVectorizer(Strings(self.arrays["terms_blob"], self.arrays["terms_offsets"]),
+                               self.arrays["idf"], **self.header["vectorizer"])
+
+    def metadata(self):
+        columns = {name: self.arrays[name] for name in ("chapters", "sections", "articles") if name in self.arrays}
+        return Metadata(self.arrays["ids"], self.arrays["types"],
+                        Strings(self.arrays["texts_blob"], self.arrays["texts_offsets"]), self.arrays.get("parents"),
+                        columns)
+
+
+class Strings:
+    """Sequence of strings stored in a UTF-8 blob, each string is decoded only when it is accessed."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return decode_string(self.blob, self.offsets, i)
+
+
+class Metadata:
+    """Columnar document metadata of an index file.
+
+    Ids and types are fixed-width byte string arrays and texts are stored in a single UTF-8 blob,
+    values are decoded only for the documents that are accessed.
+    """
+
+    def __init__(self, ids, types, texts, parents=None, columns=None):
+        self.ids = ids
+        self.types = types
+        self.texts = texts
+        self.parents = parents
+        self.columns = columns or {}
+        self._rows = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_id(self, i):
+        return self.ids[i].decode("utf-8")
+
+    def get_type(self, i):
+        return self.types[i].decode("utf-8")
+
+    def get_text(self, i):
+        return self.texts[i]
+
+    def get_parent(self, i):
+        """Returns id of the element the document was split from, or its own id if it was not split."""
+        if self.parents is None:
+            return self.get_id(i)
+        return self.parents[i].decode("utf-8")
+
+    def get_column(self, name):
+        """Returns the whole column of an optional metadata field, e.g. chapters of all documents."""
+        if name not in self.columns:
+            raise ValueError(f"Index contains no {name} of documents, please run store_embeddings.py")
+        return self.columns[name]
+
+    def find(self, element_id):
+        """Returns row of the document with the given id, or None if there is no such document."""
+        if self._rows is None:
+            self._rows = {element_id.decode("utf-8"): i for i, element_id in enumerate(self.ids)}
+        return self._rows.get(element_id)
+
+
+class QueryVectorizer:
+    """Transforms texts to TF-IDF vectors with the vocabulary and idf weights of an index file.
+
+    Produces the same vectors as the TfidfVectorizer the index was built with, without unpickling it.
+    """
+
+    def __init__(self, terms, idf, lowercase, token_pattern, norm, use_idf, sublinear_tf):
+        self.terms = terms
+        self.idf = idf
+        self.lowercase = lowercase
+        self.token_pattern = re.compile(token_pattern)
+        self.norm = norm
+        self.use_idf = use_idf
+        self.sublinear_tf = sublinear_tf
+
+    def term_index(self, term):
+        """Returns column of the term, or None if the term is not in the vocabulary."""
+        i = bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return None
+
+    def transform(self, texts):
+        data, indices, indptr = [], [], [0]
+        for text in texts:
+            counts = Counter(self.token_pattern.findall(text.lower() if self.lowercase else text))
+            row = sorted((i, count) for i, count in ((self.term_index(t), c) for t, c in counts.items()) if i is not None)
+            indices.extend(i for i, _ in row)
+            data.extend(count for _, count in row)
+            indptr.append(len(indices))
+
+        indices = np.array(indices, dtype=np.int32)
+        data = np.array(data, dtype=np.float32)
+        if self.sublinear_tf:
+            data = np.log(data) + 1
+        if self.use_idf:
+            data *= self.idf[indices]
+
+        matrix = csr_matrix((data, indices, np.array(indptr, dtype=np.int32)), shape=(len(texts), len(self.terms)))
+        if self.norm is not None:
+            normalize(matrix, norm=self.norm, copy=False)
+        return matrix
@@ -0,0 +1,154 @@
+import json
+import os
+from collections import Counter
+from itertools import islice
+
+import numpy as np
+import yaml
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer, TfidfVectorizer
+
+# Top-level lists of a corpus whose elements are indexed, articles and recitals
+ELEMENT_KEYS = ("cleni", "tocke")
+
+
+def iter_elements(path, keys=ELEMENT_KEYS):
+    """Yields (key, element) pairs of a corpus file, one element at a time.
+
+    Corpora are either YAML files with a top-level list of elements per key, or JSON Lines files
+    with one element per line, whose key is given by its "type" field.
+    """
+    if str(path).endswith(".jsonl"):
+        return iter_jsonl_elements(path, keys)
+    return iter_yaml_elements(path, keys)
+
+
+def iter_yaml_elements(path, keys=ELEMENT_KEYS):
+    """Yields (key, element) pairs of the top-level lists of a YAML file.
+
+    The file is parsed as a stream of events and only the element being read is composed into objects,
+    so memory does not grow with the size of the file. Values of other top-level keys are skipped.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        loader = yaml.SafeLoader(f)
+        try:
+            # Stream and document start
+            loader.get_event()
+            loader.get_event()
+            if not loader.check_event(yaml.MappingStartEvent):
+                raise ValueError(f"{path} does not contain a mapping of element lists")
+            loader.get_event()
+            while not loader.check_event(yaml.MappingEndEvent):
+                key = loader.construct_document(loader.compose_node(None, None))
+                if key not in keys or not loader.check_event(yaml.SequenceStartEvent):
+                    loader.compose_node(None, None)
+                    continue
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield key, loader.construct_document(loader.compose_node(None, None))
+                loader.get_event()
+        finally:
+            loader.dispose()
+
+
+def iter_jsonl_elements(path, keys=ELEMENT_KEYS):
+    """Yields (key, element) pairs of a JSON Lines file, skipping elements of other types and empty lines."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            element = json.loads(line)
+            key = element.pop("type")
+            if key in keys:
+                yield key, element
+
+
+def batched(iterable, size):
+    """Yields lists of up to size consecutive items of the iterable."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class TextSpool:
+    """Append-only file of UTF-8 texts, so texts of a corpus being indexed are not kept in memory.
+
+    The spooled texts are mapped into memory as the (blob, offsets) pair of an index file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "wb")
+        self._offsets = [0]
+
+    def append(self, texts):
+        for text in texts:
+            encoded = text.encode("utf-8")
+            self._file.write(encoded)
+            self._offsets.append(self._offsets[-1] + len(encoded))
+
+    def arrays(self):
+        """Returns (blob, offsets) of the spooled texts, the blob is mapped from the file."""
+        self._file.flush()
+        offsets = np.array(self._offsets, dtype=np.int64)
+        # Empty files cannot be mapped
+        blob = np.memmap(self.path, dtype=np.uint8, mode="r") if offsets[-1] else np.zeros(0, dtype=np.uint8)
+        return blob, offsets
+
+    def close(self):
+        """Closes and removes the spool file, closing an already closed spool does nothing."""
+        if self._file.closed:
+            return
+        self._file.close()
+        os.remove(self.path)
+
+
+class TermCounter:
+    """Builds the (documents x terms) matrix of term counts batch by batch, growing its vocabulary as it goes.
+
+    Texts are tokenized the same way as by TfidfVectorizer with default parameters, so the matrix equals
+    the one CountVectorizer fits on all texts at once, without holding the texts in memory.
+    """
+
+    def __init__(self):
+        self.analyzer = CountVectorizer().build_analyzer()
+        self.vocabulary = {}
+        self._indices, self._data, self._lengths = [], [], []
+
+    def add(self, texts):
+        indices, data = [], []
+        for text in texts:
+            counts = Counter(self.analyzer(text))
+            indices.extend(self.vocabulary.setdefault(term, len(self.vocabulary)) for term in counts)
+            data.extend(counts.values())
+            self._lengths.append(len(counts))
+        self._indices.append(np.array(indices, dtype=np.int32))
+        self._data.append(np.array(data, dtype=np.float32))
+
+    def matrix(self):
+        """Returns terms ordered alphabetically and the term count matrix with columns in the same order."""
+        terms = sorted(self.vocabulary)
+        # Columns are numbered in the order terms were first seen, they are renumbered to the sorted order
+        order = np.empty(len(terms), dtype=np.int32)
+        order[[self.vocabulary[term] for term in terms]] = np.arange(len(terms), dtype=np.int32)
+
+        indptr = np.zeros(len(self._lengths) + 1, dtype=np.int64)
+        np.cumsum(self._lengths, out=indptr[1:])
+        indices = order[np.concatenate(self._indices)] if self._indices else np.zeros(0, dtype=np.int32)
+        data = np.concatenate(self._data) if self._data else np.zeros(0, dtype=np.float32)
+        counts = csr_matrix((data, indices, indptr), shape=(len(self._lengths), len(terms)))
+        counts.sort_indices()
+        return terms, counts
+
+
+def fit_tfidf(terms, term_counts):
+    """Returns a TfidfVectorizer with the given (sorted) vocabulary and the TF-IDF matrix of the term counts.
+
+    Both equal what TfidfVectorizer(norm="l2").fit_transform would return for the texts the counts were made from.
+    """
+    transformer = TfidfTransformer(norm="l2")
+    tfidf_matrix = transformer.fit_transform(term_counts)
+    # Only the vocabulary is fitted on the terms, idf weights are those of the counted documents
+    vectorizer = TfidfVectorizer(norm="l2").fit(terms)
+    vectorizer.idf_ = transformer.idf_
+    return vectorizer, tfidf_matrix
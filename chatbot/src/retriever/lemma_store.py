@@ -0,0 +1,76 @@
+import hashlib
+import json
+import sqlite3
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class LemmaStore:
+    """SQLite store of lemmatized texts per element id, together with the hash of the text they were made from
+    and the (word form, lemma) pairs of its tokens."""
+
+    def __init__(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS lemmas (id TEXT PRIMARY KEY, hash TEXT, lemmas TEXT, forms TEXT)"
+        )
+        # Stores created before word forms were kept get the column, their elements are lemmatized again
+        if "forms" not in [row[1] for row in self._conn.execute("PRAGMA table_info(lemmas)")]:
+            self._conn.execute("ALTER TABLE lemmas ADD COLUMN forms TEXT")
+        self._conn.commit()
+
+    def get_ids(self):
+        return [element_id for element_id, in self._conn.execute("SELECT id FROM lemmas")]
+
+    def get_hashes(self, ids):
+        """Returns hashes of the given elements that are stored with word forms, keyed on element id."""
+        hashes = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            hashes.update(self._conn.execute(
+                f"SELECT id, hash FROM lemmas WHERE forms IS NOT NULL AND id IN ({placeholders})", chunk))
+        return hashes
+
+    def get_lemmas(self, ids):
+        """Returns lemmatized texts of the given elements, in the same order."""
+        return self._get_column("lemmas", ids)
+
+    def get_forms(self, ids):
+        """Returns (word form, lemma) pairs of the given elements, in the same order."""
+        return [[tuple(pair) for pair in json.loads(forms)] for forms in self._get_column("forms", ids)]
+
+    def iter_forms(self, ids, batch_size=500):
+        """Yields (word form, lemma) pairs of each of the given elements, reading batch_size elements at a time."""
+        for i in range(0, len(ids), batch_size):
+            yield from self.get_forms(ids[i:i + batch_size])
+
+    def _get_column(self, column, ids):
+        values = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            values.update(self._conn.execute(f"SELECT id, {column} FROM lemmas WHERE id IN ({placeholders})", chunk))
+        return [values[element_id] for element_id in ids]
+
+    def put(self, entries):
+        """Stores (id, hash, lemmas, forms) entries, replacing existing ones."""
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO lemmas (id, hash, lemmas, forms) VALUES (?, ?, ?, ?)",
+            [(element_id, text_hash, lemmas, json.dumps(forms)) for element_id, text_hash, lemmas, forms in entries]
+        )
+        self._conn.commit()
+
+    def delete(self, ids):
+        self._conn.executemany("DELETE FROM lemmas WHERE id = ?", [(element_id,) for element_id in ids])
+        self._conn.commit()
+
+    def clear(self):
+        self._conn.execute("DELETE FROM lemmas")
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
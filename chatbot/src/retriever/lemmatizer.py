@@ -0,0 +1,256 @@
+import queue
+import re
+import time
+from bisect import bisect_left
+from concurrent.futures import Future
+from collections import Counter
+from functools import lru_cache
+from threading import Lock, Thread, Event, current_thread
+
+from nltk.corpus import stopwords
+
+from src.config import CLASSLA_DOWNLOAD_MISSING, LEMMATIZER_WORKERS, LEMMATIZER_BATCH_WINDOW, \
+    LEMMATIZER_MAX_BATCH_SIZE
+
+# Token that separates texts, which are lemmatized together in a single classla document
+BATCH_SEPARATOR = "qqbatchseparatorqq"
+
+# Words of queries that are looked up in the dictionary of word forms
+WORD_PATTERN = re.compile(r"\w+")
+
+_download_lock = Lock()
+
+
+def create_pipeline():
+    """Creates a new classla pipeline, downloading the Slovene model first if it is missing."""
+    # classla imports torch, which is slow, so it is imported only when a pipeline is needed
+    import classla
+    try:
+        return classla.Pipeline('sl', processors='tokenize,pos,lemma')
+    except Exception:
+        if not CLASSLA_DOWNLOAD_MISSING:
+            raise
+        # Download Slovene model, since it is not available
+        with _download_lock:
+            classla.download('sl')
+        return classla.Pipeline('sl', processors='tokenize,pos,lemma')
+
+
+@lru_cache(maxsize=1)
+def get_stop_words():
+    return set(stopwords.words('slovene'))
+
+
+def is_relevant_lemma(lemma):
+    return (lemma.isalpha() or lemma.isdigit()) and lemma.lower() not in get_stop_words()
+
+
+def lemmatize_texts(nlp, texts, with_forms=False):
+    """Lemmatizes texts with a single pass of the given classla pipeline and removes stopwords.
+
+    With with_forms set, (word form, lemma) pairs of all tokens of each text are returned as well,
+    with an empty lemma for tokens that are removed.
+    """
+    if len(texts) == 0:
+        return ([], []) if with_forms else []
+
+    # Texts and separator tokens between them are separate paragraphs (separated by blank lines), so the separator
+    # is a sentence of its own and sentences, POS tags and lemmas of a text do not depend on its neighbours
+    doc = nlp(f"\n\n{BATCH_SEPARATOR}\n\n".join(text.replace(BATCH_SEPARATOR, " ") for text in texts))
+
+    lemmas = [[] for _ in texts]
+    forms = [[] for _ in texts]
+    i = 0
+    for sentence in doc.sentences:
+        for token in sentence.tokens:
+            if token.text == BATCH_SEPARATOR:
+                i += 1
+                continue
+            lemma = token.words[0].lemma.lower() if is_relevant_lemma(token.words[0].lemma) else ""
+            if lemma:
+                lemmas[i].append(lemma)
+            if with_forms:
+                forms[i].append((token.text.lower(), lemma))
+
+    joined = [' '.join(text_lemmas) for text_lemmas in lemmas]
+    return (joined, forms) if with_forms else joined
+
+
+def build_lemma_dictionary(forms):
+    """Returns the most frequent lemma of each word form, from (word form, lemma) pairs of lemmatized texts."""
+    counts = Counter(pair for text_forms in forms for pair in text_forms)
+    dictionary = {}
+    for (form, lemma), _ in counts.most_common():
+        dictionary.setdefault(form, lemma)
+    return dictionary
+
+
+class DictionaryLemmatizer:
+    """Lemmatizes texts by looking up lemmas of their words in the table of word forms seen in the corpus.
+
+    Lookups take microseconds instead of the tens of milliseconds of the classla pipeline. Words
+    missing from the table are lemmatized with the fallback, which receives them without context.
+    An empty lemma means the word is removed (e.g. a stopword).
+    """
+
+    def __init__(self, forms, lemmas):
+        # Both are sequences, ordered by word form
+        self.forms = forms
+        self.lemmas = lemmas
+
+    def lookup(self, form):
+        """Returns lemma of the word form, or None if the form is not in the table."""
+        i = bisect_left(self.forms, form)
+        if i < len(self.forms) and self.forms[i] == form:
+            return self.lemmas[i]
+        return None
+
+    def lemmatize_many(self, texts, fallback):
+        words = [WORD_PATTERN.findall(text.lower()) for text in texts]
+        lemmas = {word: self.lookup(word) for text_words in words for word in text_words}
+
+        # Unknown words of all texts are lemmatized with a single call of the fallback
+        unknown = [word for word, lemma in lemmas.items() if lemma is None]
+        if unknown:
+            lemmas.update(zip(unknown, fallback(unknown)))
+
+        return [' '.join(lemmas[word] for word in text_words if lemmas[word]) for text_words in words]
+
+
+class LemmatizationService:
+    """Pool of worker threads, each owning its own classla pipeline, which lemmatizes concurrent requests.
+
+    Requests that are queued while a worker is busy are lemmatized together as one classla document,
+    together with those that arrive within a short window after them. The heavy lifting is done by torch,
+    which releases the GIL, so workers run in parallel on multiple cores.
+
+    Workers whose pipeline fails to load stop, the others keep serving requests. Only if all workers
+    fail, requests fail with the error of the last one.
+    """
+
+    def __init__(self, workers, batch_window, max_batch_size):
+        self.workers = workers
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+
+        self._requests = queue.Queue()
+        self._threads = []
+        self._lock = Lock()
+        self._loaded_workers = 0
+        # Errors of workers whose pipeline failed to load, keyed on the name of the worker
+        self.worker_errors = {}
+        self._ready = Event()
+
+    def start(self):
+        """Starts worker threads, which load their pipelines in the background."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = Thread(target=self._run, name=f"lemmatizer-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def wait_ready(self, timeout=None):
+        """Starts the service and waits until all workers have loaded (or failed to load) their pipelines.
+
+        Raises the error of a worker if none of them loaded its pipeline.
+        """
+        self.start()
+        self._ready.wait(timeout)
+        if self._ready.is_set() and self._loaded_workers == 0:
+            raise next(iter(self.worker_errors.values()))
+
+    def is_ready(self):
+        return self._ready.is_set() and self._loaded_workers > 0
+
+    def lemmatize_many(self, texts):
+        """Lemmatizes texts, possibly in the same batch as texts of other concurrent callers."""
+        if len(texts) == 0:
+            return []
+        self.start()
+
+        future = Future()
+        self._requests.put((texts, future))
+        return future.result()
+
+    def _run(self):
+        name = current_thread().name
+        try:
+            nlp = create_pipeline()
+        except Exception as e:
+            print(f"Lemmatizer worker {name} failed to load its pipeline: {e}")
+            with self._lock:
+                self.worker_errors[name] = e
+                self._set_ready_if_loaded()
+                all_failed = len(self.worker_errors) == self.workers
+            if not all_failed:
+                return
+            # Fail all requests instead of leaving callers waiting
+            while True:
+                _, future = self._requests.get()
+                future.set_exception(e)
+
+        with self._lock:
+            self._loaded_workers += 1
+            self._set_ready_if_loaded()
+
+        while True:
+            batch = self._collect_batch()
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            try:
+                lemmas = lemmatize_texts(nlp, texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for request_texts, future in batch:
+                future.set_result(lemmas[start:start + len(request_texts)])
+                start += len(request_texts)
+
+    def _set_ready_if_loaded(self):
+        if self._loaded_workers + len(self.worker_errors) == self.workers:
+            self._ready.set()
+
+    def _collect_batch(self):
+        """Waits for a request and collects further requests that arrive within the batch window.
+
+        A request that finds the queue otherwise empty is lemmatized right away, the window is only waited
+        for while requests are queueing up, i.e. under concurrent load.
+        """
+        batch = [self._requests.get()]
+        size = len(batch[0][0])
+        if self._requests.empty():
+            return batch
+
+        deadline = time.monotonic() + self.batch_window
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[0])
+
+        return batch
+
+
+_service = None
+_service_lock = Lock()
+
+
+def get_lemmatization_service():
+    """Returns the process-wide lemmatization service, or None if it is disabled."""
+    global _service
+    if LEMMATIZER_WORKERS <= 0:
+        return None
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = LemmatizationService(LEMMATIZER_WORKERS, LEMMATIZER_BATCH_WINDOW, LEMMATIZER_MAX_BATCH_SIZE)
+    return _service
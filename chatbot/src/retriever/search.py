@@ -2,71 +2,171 @@ from typing import List
 
 import numpy as np
 from langchain_core.documents import Document
-from sklearn.metrics.pairwise import cosine_similarity
 
-from src.retriever.util import EmbeddingManager, preprocess
+from src.config import PARENT_CHUNK_OVERFETCH, DEFAULT_CORPUS
+from src.retriever.filters import filter_key
+from src.retriever.util import get_snapshot, preprocess, preprocess_many, search_cache
 
 
-def search(query, top_n=None):
-    # Get the singleton instance and load embeddings
-    embedding_manager = EmbeddingManager.get_instance()
+def top_k_cache_key(preprocessed_query, top_n, index_version, engine, granularity, filters):
+    return f"{index_version}|{granularity}|{engine}|{filter_key(filters)}|{top_n}|{preprocessed_query}"
+
+
+def get_cached_top_k(cache_key):
+    cached = search_cache.get(cache_key)
+    if cached is None:
+        return None
+    top_indices, similarity_scores = cached
+    return np.array(top_indices, dtype=np.int64), np.array(similarity_scores, dtype=np.float32)
+
+
+def cache_top_k(cache_key, top_k):
+    top_indices, similarity_scores = top_k
+    search_cache.put(cache_key, [top_indices.tolist(), similarity_scores.tolist()])
+
+
+def search_top_k(query, top_n=None, engine="tfidf", granularity="documents", filters=None, corpus=DEFAULT_CORPUS,
+                 snapshot=None):
+    """Returns indices and similarity scores of the top n documents for the query, found by the given engine.
+
+    With granularity "chunks", indices are rows of the chunk index. With granularity "parents", chunks are
+    searched and mapped to their parent documents, each scored by its best chunk.
+
+    Only documents that satisfy the filters (see src.retriever.filters) are searched. Indices refer to the given
+    snapshot of the index of the corpus, by default the one in use when the search starts.
+    """
+    snapshot = snapshot or get_snapshot(corpus)
+    if granularity == "parents":
+        return to_parent_top_k(*search_top_k(query, chunk_top_n(top_n), engine, "chunks", filters, corpus, snapshot),
+                               top_n, snapshot)
+
+    embedding_manager = snapshot.get_embedding_manager(granularity)
     embedding_manager.load_embeddings()
 
     vectorizer = embedding_manager.get_vectorizer()
-    tfidf_matrix = embedding_manager.get_tfidf_matrix()
-    metadata = embedding_manager.get_metadata()
+    search_engine = embedding_manager.get_search_engine(engine, filters)
+
+    preprocessed_query = preprocess(query, corpus=corpus)
 
-    preprocessed_query = preprocess(query)
+    cache_key = top_k_cache_key(preprocessed_query, top_n, snapshot.version, engine, granularity, filters)
+    cached = get_cached_top_k(cache_key)
+    if cached is not None:
+        return cached
 
     # Convert the query to a TF-IDF vector
     query_vector = vectorizer.transform([preprocessed_query])
 
-    similarity_scores = cosine_similarity(query_vector, tfidf_matrix).flatten()
+    top_k = search_engine.search(query_vector, top_n)
+    cache_top_k(cache_key, top_k)
+    return top_k
 
-    if top_n is None:
-        # Take all relevant results
-        top_indices = np.argsort(similarity_scores)[::-1]
-    else:
-        # Take only the top n relevant results
-        top_indices = np.argsort(similarity_scores)[-top_n:][::-1]
-
-    return [
-        {
-            "id": metadata[i]["id"],
-            "similarity_score": similarity_scores[i],
-            "text": metadata[i].get("raw_text", "")  # Ensure text is included in metadata
-        }
-        for i in top_indices
-    ]
 
+def search_top_k_many(queries, top_n=None, engine="tfidf", granularity="documents", filters=None,
+                      corpus=DEFAULT_CORPUS, snapshot=None):
+    """Returns indices and similarity scores of the top n documents for each of the queries."""
+    snapshot = snapshot or get_snapshot(corpus)
+    if granularity == "parents":
+        return [to_parent_top_k(*top_k, top_n, snapshot)
+                for top_k in search_top_k_many(queries, chunk_top_n(top_n), engine, "chunks", filters, corpus,
+                                               snapshot)]
 
-def search_documents(query, top_n=None) -> List[Document]:
-    """Method that returns results in suitable format for use in LangChain retrievers"""
-    # Get the singleton instance and load embeddings
-    embedding_manager = EmbeddingManager.get_instance()
+    embedding_manager = snapshot.get_embedding_manager(granularity)
     embedding_manager.load_embeddings()
 
     vectorizer = embedding_manager.get_vectorizer()
-    tfidf_matrix = embedding_manager.get_tfidf_matrix()
-    metadata = embedding_manager.get_metadata()
+    search_engine = embedding_manager.get_search_engine(engine, filters)
 
-    preprocessed_query = preprocess(query)
+    preprocessed_queries = preprocess_many(queries, corpus=corpus)
 
-    # Convert the query to a TF-IDF vector
-    query_vector = vectorizer.transform([preprocessed_query])
+    cache_keys = [top_k_cache_key(preprocessed_query, top_n, snapshot.version, engine, granularity, filters)
+                  for preprocessed_query in preprocessed_queries]
+    results = [get_cached_top_k(cache_key) for cache_key in cache_keys]
+    missing = [i for i, cached in enumerate(results) if cached is None]
+    if not missing:
+        return results
+
+    # Convert all queries that are not cached to a single sparse matrix of TF-IDF vectors
+    query_matrix = vectorizer.transform([preprocessed_queries[i] for i in missing])
+
+    for i, top_k in zip(missing, search_engine.search_many(query_matrix, top_n)):
+        results[i] = top_k
+        cache_top_k(cache_keys[i], top_k)
+    return results
 
-    similarity_scores = cosine_similarity(query_vector, tfidf_matrix).flatten()
 
-    if top_n is None:
-        # Take all relevant results
-        top_indices = np.argsort(similarity_scores)[::-1]
-    else:
-        # Take only the top n relevant results
-        top_indices = np.argsort(similarity_scores)[-top_n:][::-1]
+def chunk_top_n(top_n):
+    return None if top_n is None else top_n * PARENT_CHUNK_OVERFETCH
 
+
+def to_parent_top_k(top_indices, similarity_scores, top_n, snapshot):
+    """Maps ranked chunks to rows of their parent documents, keeping the first (best) chunk of each parent."""
+    chunk_metadata = snapshot.get_embedding_manager("chunks").get_metadata()
+    document_metadata = snapshot.get_embedding_manager("documents").get_metadata()
+
+    parents, scores = [], []
+    seen = set()
+    for i, score in zip(top_indices, similarity_scores):
+        parent = chunk_metadata.get_parent(i)
+        if parent in seen:
+            continue
+        seen.add(parent)
+        parents.append(document_metadata.find(parent))
+        scores.append(score)
+        if len(parents) == top_n:
+            break
+    return np.array(parents, dtype=np.int64), np.array(scores, dtype=np.float32)
+
+
+def to_results(top_indices, similarity_scores, granularity, snapshot):
+    metadata = snapshot.get_embedding_manager(granularity).get_metadata()
+    return [
+        {
+            "id": metadata.get_id(i),
+            "similarity_score": float(score),
+            "text": metadata.get_text(i)
+        }
+        for i, score in zip(top_indices, similarity_scores)
+    ]
+
+
+def to_documents(top_indices, similarity_scores, granularity, snapshot) -> List[Document]:
+    metadata = snapshot.get_embedding_manager(granularity).get_metadata()
     return [
         Document(
-            page_content=metadata[i].get("raw_text", ""),
-            metadata={"id": metadata[i]["id"], "type": metadata[i]["type"], "similarity_score": float(similarity_scores[i])},
-        ) for i in top_indices
+            page_content=metadata.get_text(i),
+            metadata={"id": metadata.get_id(i), "type": metadata.get_type(i), "parent_id": metadata.get_parent(i),
+                      "similarity_score": float(score)},
+        ) for i, score in zip(top_indices, similarity_scores)
     ]
+
+
+# Each search takes the snapshot of the index of the corpus once, so results are formatted with the index they
+# were found in, even if a new index is loaded in the meantime
+
+def search(query, top_n=None, engine="tfidf", granularity="documents", filters=None, corpus=DEFAULT_CORPUS):
+    snapshot = get_snapshot(corpus)
+    return to_results(*search_top_k(query, top_n, engine, granularity, filters, corpus, snapshot), granularity,
+                      snapshot)
+
+
+def search_many(queries, top_n=None, engine="tfidf", granularity="documents", filters=None, corpus=DEFAULT_CORPUS):
+    """Searches multiple queries at once, returns a list of results for each query."""
+    snapshot = get_snapshot(corpus)
+    return [to_results(*top_k, granularity, snapshot)
+            for top_k in search_top_k_many(queries, top_n, engine, granularity, filters, corpus, snapshot)]
+
+
+def search_documents(query, top_n=None, engine="tfidf", granularity="documents", filters=None,
+                     corpus=DEFAULT_CORPUS) -> List[Document]:
+    """Method that returns results in suitable format for use in LangChain retrievers"""
+    snapshot = get_snapshot(corpus)
+    return to_documents(*search_top_k(query, top_n, engine, granularity, filters, corpus, snapshot), granularity,
+                        snapshot)
+
+
+def search_documents_many(queries, top_n=None, engine="tfidf", granularity="documents",
+                          filters=None, corpus=DEFAULT_CORPUS) -> List[List[Document]]:
+    """Batched variant of search_documents, returns a list of documents for each query."""
+    snapshot = get_snapshot(corpus)
+    return [to_documents(*top_k, granularity, snapshot)
+            for top_k in search_top_k_many(queries, top_n, engine, granularity, filters, corpus, snapshot)]
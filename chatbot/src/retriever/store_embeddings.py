@@ -1,52 +1,272 @@
-import yaml
-from sklearn.feature_extraction.text import TfidfVectorizer
+import argparse
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
 
-from src.config import AI_ACT_YAML_PATH
-from src.retriever.util import EmbeddingManager, preprocess
+from src.config import LEMMA_STORE_FILE_NAME, LSA_COMPONENTS, BM25_K1, BM25_B, CHUNK_MAX_CHARS, \
+    INDEX_BUILDS_DIR_NAME, INDEX_BUILDS_KEPT, INDEX_FILE_NAME, CHUNK_INDEX_FILE_NAME, DEFAULT_CORPUS, CORPORA, \
+    INGEST_BATCH_SIZE
+from src.retriever.chunking import chunk_element, position
+from src.retriever.engine import fit_lsa, fit_bm25
+from src.retriever.ingest import batched, TextSpool, TermCounter, fit_tfidf
+from src.retriever.index_file import write_manifest, prune_builds, encode_lemma_dictionary
+from src.retriever.lemma_store import LemmaStore, content_hash
+from src.retriever.lemmatizer import create_pipeline, lemmatize_texts, build_lemma_dictionary
+from src.retriever.util import EmbeddingManager, get_nlp, get_corpus, get_manifest_path, get_document_store
 
+# Classla pipeline of a worker process, created once per worker by init_worker
+_worker_nlp = None
 
-def process_section(data, key):
-    """Processes either 'cleni' or 'tocke' and returns preprocessed text + metadata."""
-    metadata, preprocessed_texts = [], []
-    for d in data[key]:
-        if key == "cleni":
-            text = (
-                    d['poglavje']['naslov'] + "\n" +
-                    (d['oddelek']['naslov'] + "\n" if d['oddelek'] else '') +
-                    d['naslov'] + "\n" +
-                    d['vsebina']
-            )
-        else:
-            text = (d['vsebina'])
 
-        preprocessed_text = preprocess(text)
+def init_worker():
+    global _worker_nlp
+    _worker_nlp = create_pipeline()
 
-        preprocessed_texts.append(preprocessed_text)
-        metadata.append({"id": d['id_elementa'], "type": key, "raw_text": text})
-    return {"metadata": metadata, "preprocessed_embeddings": preprocessed_texts}
 
+def lemmatize_chunk(texts):
+    return lemmatize_texts(_worker_nlp, texts, with_forms=True)
 
-def prepare_data():
-    """Reads YAML file, preprocesses text, and stores TF-IDF embeddings."""
-    with open(AI_ACT_YAML_PATH, "r") as file:
-        data = yaml.safe_load(file)
 
-    print("Storing embeddings...")
+def element_text(d, key):
+    """Returns the indexed text of an element of either 'cleni' or 'tocke'."""
+    if key != "cleni":
+        return d['vsebina']
+    return (
+            d['poglavje']['naslov'] + "\n" +
+            (d['oddelek']['naslov'] + "\n" if d['oddelek'] else '') +
+            d['naslov'] + "\n" +
+            d['vsebina']
+    )
 
-    datasets = {key: process_section(data, key) for key in ["cleni", "tocke"]}
 
-    all_texts, all_metadata = [], []
-    for key, values in datasets.items():
-        all_texts += values["preprocessed_embeddings"]
-        all_metadata += values["metadata"]
+def preprocess_corpus(texts, executor=None, batch_size=16):
+    """Lemmatizes texts in batches, in parallel over a pool of worker processes if an executor is given.
 
-    # Train a joint model for both 'cleni' and 'tocke'
-    vectorizer = TfidfVectorizer(norm="l2")
-    tfidf_matrix = vectorizer.fit_transform(all_texts)
+    Returns lemmatized texts and (word form, lemma) pairs of their tokens.
+    """
+    chunks = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = [None] * len(chunks)
+    done = 0
 
-    EmbeddingManager().get_instance().save_data(vectorizer, tfidf_matrix, all_metadata)
+    def report_progress(chunk):
+        nonlocal done
+        done += len(chunk)
+        print(f"\rLemmatized {done}/{len(texts)} documents", end="", flush=True)
+
+    if executor is None:
+        nlp = get_nlp()
+        for i, chunk in enumerate(chunks):
+            results[i] = lemmatize_texts(nlp, chunk, with_forms=True)
+            report_progress(chunk)
+    else:
+        futures = {executor.submit(lemmatize_chunk, chunk): i for i, chunk in enumerate(chunks)}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            report_progress(chunks[i])
+    print()
+
+    return ([lemmas for chunk_lemmas, _ in results for lemmas in chunk_lemmas],
+            [forms for _, chunk_forms in results for forms in chunk_forms])
+
+
+def update_lemmas(lemma_store, ids, texts, executor=None, batch_size=16):
+    """Lemmatizes only elements that were added or changed since the last build.
+
+    Returns lemmas of all the given elements and the number of lemmatized ones.
+    """
+    stored_hashes = lemma_store.get_hashes(ids)
+    hashes = [content_hash(text) for text in texts]
+
+    changed = [i for i, (element_id, text_hash) in enumerate(zip(ids, hashes)) if stored_hashes.get(element_id) != text_hash]
+    if changed:
+        lemmas, forms = preprocess_corpus([texts[i] for i in changed], executor, batch_size)
+        lemma_store.put([(ids[i], hashes[i], element_lemmas, element_forms)
+                         for i, element_lemmas, element_forms in zip(changed, lemmas, forms)])
+
+    return lemma_store.get_lemmas(ids), len(changed)
+
+
+class IndexBuilder:
+    """Collects metadata, texts and term counts of the documents of one index, batch by batch.
+
+    Texts are spooled to a file next to the index and lemmas are only counted, so neither is held in memory.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.metadata = []
+        self.texts = TextSpool(index_path.with_name(index_path.name + ".texts"))
+        self.term_counter = TermCounter()
+
+    def add(self, metadata, lemmas):
+        self.texts.append(m["raw_text"] for m in metadata)
+        self.metadata += [{name: value for name, value in m.items() if name != "raw_text"} for m in metadata]
+        self.term_counter.add(lemmas)
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def close(self):
+        """Removes the spooled texts, once they are written to the index or the build failed."""
+        self.texts.close()
+
+
+def build_index(builder, version, lsa_components, timings, extra_arrays=None):
+    """Fits TF-IDF, BM25 and LSA representations of the counted documents and stores them to the index file."""
+    name = builder.index_path.stem
+
+    start = time.perf_counter()
+    # One model for all documents of the index, articles and recitals of the document index or chunks of both
+    terms, term_counts = builder.term_counter.matrix()
+    vectorizer, tfidf_matrix = fit_tfidf(terms, term_counts)
+    timings[f"{name} vectorization"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    extra_arrays = {**fit_bm25(term_counts, BM25_K1, BM25_B), **(extra_arrays or {})}
+    del term_counts
+    timings[f"{name} bm25"] = time.perf_counter() - start
+
+    if lsa_components > 0:
+        start = time.perf_counter()
+        extra_arrays.update(fit_lsa(tfidf_matrix, lsa_components))
+        timings[f"{name} lsa"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    EmbeddingManager.save_data(vectorizer, tfidf_matrix, builder.metadata, builder.index_path, version, extra_arrays,
+                               builder.texts.arrays())
+    builder.close()
+    timings[f"{name} saving"] = time.perf_counter() - start
+
+
+def prepare_data(workers=1, batch_size=16, full=False, lsa_components=LSA_COMPONENTS, corpus=DEFAULT_CORPUS,
+                 ingest_batch_size=INGEST_BATCH_SIZE):
+    """Streams elements of the corpus, preprocesses text, and stores TF-IDF embeddings of elements and of their chunks.
+
+    Elements are read from the document store of the corpus (see src.retriever.document_store), and are
+    lemmatized and counted ingest_batch_size at a time. Their texts are spooled to the build directory and
+    their lemmas are kept in the lemma store, so memory holds only the term counts and metadata of the
+    indexes being built, however large the corpus is.
+
+    Only elements and chunks whose text changed since the last build are lemmatized again, unless full is set.
+    BM25 weights are stored as well, and LSA document vectors with lsa_components dimensions, unless
+    lsa_components is 0.
+
+    Both indexes are written to a new build directory, which replaces the build in use only once the
+    manifest points to it, so a running API can load it without ever seeing a partially written build.
+    """
+    index_dir = get_corpus(corpus)["index_dir"]
+    # Compiled again first if the source file of the corpus changed
+    document_store = get_document_store(corpus)
+    builds_dir = index_dir / INDEX_BUILDS_DIR_NAME
+    timings = {"reading": 0.0, "lemmatization": 0.0}
+
+    # Documents and chunks of a build share its version, which also invalidates cached search results
+    version = uuid.uuid4().hex
+    build_dir = builds_dir / version
+    build_dir.mkdir(parents=True)
+    documents = IndexBuilder(build_dir / INDEX_FILE_NAME)
+    chunks = IndexBuilder(build_dir / CHUNK_INDEX_FILE_NAME)
+    built = False
+    try:
+        print(f"Storing embeddings of corpus {corpus}...")
+
+        lemma_store = LemmaStore(index_dir / LEMMA_STORE_FILE_NAME)
+        if full:
+            lemma_store.clear()
+        indexed_ids, changed = [], 0
+
+        # Spawned workers do not inherit state (threads, torch) of this process, each loads its own pipeline
+        # once it is given its first texts, so unchanged corpora do not load the pipeline at all
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=init_worker) if workers > 1 else None
+        try:
+            start = time.perf_counter()
+            for batch in batched(document_store.iter_elements(), ingest_batch_size):
+                document_metadata = [{"id": d['id_elementa'], "type": key, "raw_text": element_text(d, key),
+                                      **position(d, key)} for key, d in batch]
+                chunk_metadata = [chunk for key, d in batch for chunk in chunk_element(d, key, CHUNK_MAX_CHARS)]
+
+                # Elements and chunks are lemmatized together, recitals are not split, so they are lemmatized once
+                texts_by_id = {m["id"]: m["raw_text"] for m in document_metadata}
+                texts_by_id.update((m["id"], m["raw_text"]) for m in chunk_metadata if m["id"] not in texts_by_id)
+
+                lemmatization_start = time.perf_counter()
+                lemmas, batch_changed = update_lemmas(lemma_store, list(texts_by_id), list(texts_by_id.values()),
+                                                      executor, batch_size)
+                timings["lemmatization"] += time.perf_counter() - lemmatization_start
+                lemmas = dict(zip(texts_by_id, lemmas))
+                indexed_ids += texts_by_id
+                changed += batch_changed
+
+                documents.add(document_metadata, [lemmas[m["id"]] for m in document_metadata])
+                chunks.add(chunk_metadata, [lemmas[m["id"]] for m in chunk_metadata])
+            # Reading, chunking and counting terms of the elements
+            timings["reading"] = time.perf_counter() - start - timings["lemmatization"]
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        removed = set(lemma_store.get_ids()) - set(indexed_ids)
+        if removed:
+            lemma_store.delete(list(removed))
+        print(f"{changed} added or changed, {len(indexed_ids) - changed} unchanged and {len(removed)} removed "
+              f"elements")
+
+        start = time.perf_counter()
+        # Lemmas of all word forms of the corpus, with which queries are lemmatized without the classla pipeline
+        lemma_dictionary = build_lemma_dictionary(lemma_store.iter_forms(indexed_ids))
+        lemma_store.close()
+        timings["lemma dictionary"] = time.perf_counter() - start
+
+        build_index(documents, version, lsa_components, timings, encode_lemma_dictionary(lemma_dictionary))
+        build_index(chunks, version, lsa_components, timings)
+
+        write_manifest(get_manifest_path(corpus), {
+            "version": version,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "files": {
+                "documents": documents.index_path.relative_to(index_dir).as_posix(),
+                "chunks": chunks.index_path.relative_to(index_dir).as_posix(),
+            },
+        })
+        built = True
+    finally:
+        documents.close()
+        chunks.close()
+        # A failed or interrupted build must not be left behind, it would count as one of the builds kept
+        if not built:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    prune_builds(builds_dir, INDEX_BUILDS_KEPT, version)
+
+    print(f"Embeddings saved as build {version}!")
+
+    print(f"\nIndexed {len(documents)} documents and {len(chunks)} chunks with {workers} worker(s):")
+    for step, duration in timings.items():
+        print(f"  {step:<22}{duration:8.2f} s")
+    print(f"  {'total':<22}{sum(timings.values()):8.2f} s")
 
-    print("Embeddings saved!")
 
 if __name__ == "__main__":
-    prepare_data()
+    parser = argparse.ArgumentParser(description="Lemmatizes the AI Act and stores its TF-IDF embeddings.")
+    # Each worker loads its own classla pipeline (about 1 GB), so only a few are started by default
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                        help="number of worker processes for lemmatization, each with its own classla pipeline")
+    parser.add_argument("--batch-size", type=int, default=16,
+                        help="number of documents lemmatized together as one classla document")
+    parser.add_argument("--ingest-batch-size", type=int, default=INGEST_BATCH_SIZE,
+                        help="number of elements read, lemmatized and counted at a time")
+    parser.add_argument("--full", action="store_true",
+                        help="lemmatize all elements again instead of only the added or changed ones")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, choices=list(CORPORA),
+                        help="corpus whose embeddings are stored")
+    parser.add_argument("--lsa-components", type=int, default=LSA_COMPONENTS,
+                        help="dimensions of the LSA document vectors, 0 skips the LSA engine")
+    args = parser.parse_args()
+
+    prepare_data(args.workers, args.batch_size, args.full, args.lsa_components, args.corpus, args.ingest_batch_size)
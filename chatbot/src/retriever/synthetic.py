@@ -0,0 +1,146 @@
+import argparse
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+from src.config import BM25_K1, BM25_B, SEARCH_SHARD_SIZE, SEARCH_THREADS
+from src.retriever.benchmark import summarize_latencies
+from src.retriever.engine import fit_bm25, ShardedEngine
+from src.retriever.ingest import fit_tfidf
+from src.retriever.util import EmbeddingManager, get_embedding_manager
+
+
+def term_distribution():
+    """Returns terms of the AI Act index and probabilities of sampling them, proportional to their document frequency.
+
+    Synthetic documents use the real vocabulary, so real (lemmatized) queries can be searched in them.
+    """
+    index = get_embedding_manager().get_index()
+    vectorizer = index.vectorizer()
+    terms = [vectorizer.terms[i] for i in range(len(vectorizer.terms))]
+    postings_ptr, _, _ = index.postings()
+    frequencies = np.diff(postings_ptr).astype(np.float64)
+    return terms, frequencies / frequencies.sum()
+
+
+def generate_counts(n_documents, probabilities, mean_length=150, seed=0, batch_size=10_000):
+    """Generates a (documents x terms) matrix of term counts with log-normally distributed document lengths.
+
+    Documents are generated in batches, so memory is bounded by the counts of the generated documents.
+    """
+    rng = np.random.default_rng(seed)
+    batches = []
+    for start in range(0, n_documents, batch_size):
+        size = min(batch_size, n_documents - start)
+        lengths = np.maximum(rng.lognormal(np.log(mean_length), 0.6, size).astype(np.int64), 1)
+        rows = np.repeat(np.arange(size), lengths)
+        columns = rng.choice(len(probabilities), size=lengths.sum(), p=probabilities)
+        # Duplicate (row, column) pairs are summed into counts
+        batches.append(csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                                  shape=(size, len(probabilities))))
+    return vstack(batches, format="csr")
+
+
+def build_synthetic_index(n_documents, path, mean_length=150, seed=0):
+    """Generates a synthetic corpus of n_documents and writes its index file (TF-IDF and BM25) to the path."""
+    terms, probabilities = term_distribution()
+    counts = generate_counts(n_documents, probabilities, mean_length, seed)
+
+    vectorizer, tfidf_matrix = fit_tfidf(terms, counts)
+    metadata = [{"id": f"syn_{i}", "type": "synthetic"} for i in range(n_documents)]
+    EmbeddingManager.save_data(vectorizer, tfidf_matrix, metadata, path, f"synthetic-{n_documents}",
+                               fit_bm25(counts, BM25_K1, BM25_B))
+
+
+def sample_queries(n_queries, seed=1):
+    """Samples queries of 3 to 8 terms from the vocabulary of the AI Act."""
+    terms, probabilities = term_distribution()
+    rng = np.random.default_rng(seed)
+    return [" ".join(terms[i] for i in rng.choice(len(terms), size=rng.integers(3, 9), p=probabilities))
+            for _ in range(n_queries)]
+
+
+def time_search(engine, query_matrix, top_n, repeat):
+    latencies = []
+    for _ in range(repeat):
+        for i in range(query_matrix.shape[0]):
+            start = time.perf_counter()
+            engine.search(query_matrix[i], top_n)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    engine.search_many(query_matrix, top_n)
+    return {"latency_ms": summarize_latencies(latencies),
+            "batch_throughput_qps": query_matrix.shape[0] / (time.perf_counter() - start)}
+
+
+def benchmark_scaling(sizes, engines, shard_size, threads, n_queries=50, top_n=10, repeat=3):
+    """Builds a synthetic index of each size and compares latency of a single engine with a sharded one.
+
+    Synthetic indexes hold only TF-IDF and BM25 weights, so only the tfidf and bm25 engines can be compared.
+    """
+    queries = sample_queries(n_queries)
+    executor = ThreadPoolExecutor(threads, thread_name_prefix="search")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for n_documents in sizes:
+            path = Path(directory) / f"synthetic_{n_documents}.bin"
+            start = time.perf_counter()
+            build_synthetic_index(n_documents, path)
+            build_time = time.perf_counter() - start
+
+            embedding_manager = EmbeddingManager(path)
+            query_matrix = embedding_manager.get_vectorizer().transform(queries)
+            results[n_documents] = {"build_s": build_time}
+            for name in engines:
+                # The engine of the manager is sharded only above SEARCH_SHARD_SIZE, so both are built here
+                engine = embedding_manager.get_search_engine(name)
+                engine = getattr(engine, "engine", engine)
+                sharded = ShardedEngine(engine, shard_size, executor)
+                results[n_documents][name] = {
+                    "single": time_search(engine, query_matrix, top_n, repeat),
+                    f"{len(sharded.shards)} shards": time_search(sharded, query_matrix, top_n, repeat),
+                }
+            print(f"Benchmarked {n_documents} documents")
+    executor.shutdown()
+    return results
+
+
+def print_results(results):
+    print(f"\n{'documents':>10}  {'engine':<8}{'search':<12}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'batch q/s':>12}")
+    for n_documents, size_results in results.items():
+        for name, engine_results in size_results.items():
+            if name == "build_s":
+                continue
+            for variant, result in engine_results.items():
+                latencies = "".join(f"{value:>10.3f}" for value in result["latency_ms"].values())
+                print(f"{n_documents:>10}  {name:<8}{variant:<12}{latencies}{result['batch_throughput_qps']:>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks scaling of search over synthetic corpora with the vocabulary of the AI Act.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[500, 5_000, 50_000, 200_000],
+                        help="numbers of documents of the synthetic corpora")
+    # Synthetic indexes hold only TF-IDF and BM25 weights, and fusion is never sharded
+    parser.add_argument("--engines", nargs="+", choices=["tfidf", "bm25"], default=["tfidf", "bm25"],
+                        help="search engines to compare")
+    parser.add_argument("--shard-size", type=int, default=SEARCH_SHARD_SIZE, help="documents per shard")
+    parser.add_argument("--threads", type=int, default=SEARCH_THREADS, help="threads that search shards")
+    parser.add_argument("--repeat", type=int, default=3, help="number of times each query is searched")
+    parser.add_argument("--output", help="path of a JSON file the results are written to")
+    args = parser.parse_args()
+
+    scaling_results = benchmark_scaling(args.sizes, args.engines, args.shard_size, args.threads, repeat=args.repeat)
+    print_results(scaling_results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(scaling_results, f, indent=2)
+        print(f"Results written to {args.output}")
@@ -1,82 +1,433 @@
-import json
 import os
-import joblib
-import numpy as np
-import classla
-from nltk.corpus import stopwords
-from scipy.sparse import save_npz, load_npz
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
-from src.config import EMBEDDINGS_PATH, METADATA_PATH, VECTORIZER_PATH
+from src.config import QUERY_CACHE_SIZE, PERSIST_QUERY_CACHE, QUERY_CACHE_PATH, RRF_K, RRF_DEPTH, \
+    INDEX_MANIFEST_FILE_NAME, FILTERED_ENGINE_CACHE_SIZE, QUERY_LEMMATIZER, CORPORA, DEFAULT_CORPUS, \
+    INDEX_MEMORY_BUDGET_MB, SEARCH_SHARD_SIZE, SEARCH_THREADS, DOCUMENT_STORE_FILE_NAME
+from src.retriever.cache import LRUCache, normalize_query
+from src.retriever.document_store import DocumentStore, compile_document_store, file_checksum
+from src.retriever.engine import SparseTopKEngine, DenseTopKEngine, FusionEngine, ShardedEngine
+from src.retriever.filters import filter_key, filter_rows
+from src.retriever.index_file import IndexFile, write_index, read_manifest
+from src.retriever.lemmatizer import create_pipeline, lemmatize_texts, get_lemmatization_service, \
+    DictionaryLemmatizer
 
-# Download Slovene model if not available
-classla.download('sl')
-nlp = classla.Pipeline('sl', processors='tokenize,pos,lemma')
-stop_words = set(stopwords.words('slovene'))
+# The classla pipeline is loaded lazily on first use (or in warm_up), so importing this module
+# does not load the model nor access the network
+_nlp = None
+_nlp_lock = Lock()
 
+# Lemmatized queries, keyed on lemmatizer, corpus, index version (dictionary lemmatizer) and normalized query text
+preprocess_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_PATH if PERSIST_QUERY_CACHE else None, "preprocess_cache")
+# Corpora whose index has no word form table for the dictionary lemmatizer, reported once
+_dictionary_fallbacks = set()
+# Compiled document stores of corpora, opened on first use
+_document_stores = {}
+_document_stores_lock = Lock()
+# Threads that search shards of large indexes, shared by all indexes
+_search_executor = None
+_search_executor_lock = Lock()
 
-class EmbeddingManager:
-    """Manages storage and retrieval of TF-IDF embeddings."""
+# Top-k search results, keyed on lemmatized query, number of results, granularity, engine and index version
+search_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_PATH if PERSIST_QUERY_CACHE else None, "search_cache")
 
-    _instance = None
 
-    @staticmethod
-    def get_instance():
-        """Returns the singleton instance."""
-        if EmbeddingManager._instance is None:
-            EmbeddingManager._instance = EmbeddingManager()
-        return EmbeddingManager._instance
+def get_nlp():
+    """Returns the classla pipeline, loading it on first call."""
+    global _nlp
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                _nlp = create_pipeline()
+    return _nlp
+
+
+def get_search_executor():
+    """Returns the thread pool that searches shards of indexes, creating it on first call."""
+    global _search_executor
+    if _search_executor is None:
+        with _search_executor_lock:
+            if _search_executor is None:
+                _search_executor = ThreadPoolExecutor(SEARCH_THREADS, thread_name_prefix="search")
+    return _search_executor
+
+
+def is_nlp_loaded():
+    service = get_lemmatization_service()
+    if service is not None:
+        return service.is_ready()
+    return _nlp is not None
+
+
+class EmbeddingManager:
+    """Manages storage and retrieval of TF-IDF embeddings of one index file."""
 
-    def __init__(self):
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self._index = None
         self._vectorizer = None
         self._tfidf_matrix = None
         self._metadata = None
+        self._lemma_dictionary = None
+        self._search_engines = {}
+        # Engines restricted to the rows of search filters, keyed on engine name and filters
+        self._filtered_engines = LRUCache(FILTERED_ENGINE_CACHE_SIZE)
+
+    def get_index(self):
+        """Opens the memory-mapped index file or returns it from cache."""
+        if self._index is None:
+            self._index = IndexFile(self.index_path)
+        return self._index
 
     def get_vectorizer(self):
-        """Loads vectorizer from disk or cache."""
+        """Loads query vectorizer from the index or cache."""
         if self._vectorizer is None:
-            self._vectorizer = joblib.load(VECTORIZER_PATH)
+            self._vectorizer = self.get_index().vectorizer()
         return self._vectorizer
 
     def get_tfidf_matrix(self):
-        """Loads TF-IDF matrix from disk or cache."""
+        """Loads TF-IDF matrix from the index or cache."""
         if self._tfidf_matrix is None:
-            self._tfidf_matrix = load_npz(EMBEDDINGS_PATH)
+            self._tfidf_matrix = self.get_index().tfidf_matrix()
         return self._tfidf_matrix
 
     def get_metadata(self):
-        """Loads metadata from disk or cache."""
+        """Loads metadata from the index or cache."""
         if self._metadata is None:
-            with open(METADATA_PATH, "r") as f:
-                self._metadata = np.array(json.load(f))
+            self._metadata = self.get_index().metadata()
         return self._metadata
 
+    def get_lemma_dictionary(self):
+        """Returns lemmatizer with the word form table of the index, or None if the index contains no table."""
+        if self._lemma_dictionary is None:
+            table = self.get_index().lemma_dictionary()
+            # False marks an index without a table, so it is not looked up again
+            self._lemma_dictionary = DictionaryLemmatizer(*table) if table is not None else False
+        return self._lemma_dictionary or None
+
+    def get_search_engine(self, name="tfidf", filters=None):
+        """Builds top-k search engine or returns it from cache.
+
+        Engine "tfidf" matches query terms over the stored inverted index, engine "bm25" does the same
+        with BM25 weights, engine "fusion" combines rankings of both with reciprocal-rank fusion and
+        engine "lsa" searches the dense LSA document vectors.
+
+        With filters, the engine holds only the documents that satisfy them, so filtered searches
+        score fewer documents instead of filtering the results of a search over the whole index.
+
+        Indexes with more than SEARCH_SHARD_SIZE documents are searched in shards, in parallel.
+        """
+        if filters:
+            key = f"{name}|{filter_key(filters)}"
+            engine = self._filtered_engines.get(key)
+            if engine is None:
+                engine = self.get_search_engine(name).subset(filter_rows(self.get_metadata(), filters))
+                self._filtered_engines.put(key, engine)
+            return engine
+
+        if name not in self._search_engines:
+            index = self.get_index()
+            if name == "tfidf":
+                engine = SparseTopKEngine(*index.postings(), len(self.get_metadata()))
+            elif name == "bm25":
+                engine = SparseTopKEngine(*index.bm25(), len(self.get_metadata()), binary_queries=True)
+            elif name == "fusion":
+                engine = FusionEngine([self.get_search_engine("bm25"), self.get_search_engine("tfidf")],
+                                      RRF_K, RRF_DEPTH)
+            elif name == "lsa":
+                engine = DenseTopKEngine(*index.lsa())
+            else:
+                raise ValueError(f"Unknown search engine: {name}")
+            # Fusion combines engines that are already sharded
+            if name != "fusion" and engine.n_documents > SEARCH_SHARD_SIZE:
+                engine = ShardedEngine(engine, SEARCH_SHARD_SIZE, get_search_executor())
+            self._search_engines[name] = engine
+        return self._search_engines[name]
+
+    def get_index_version(self):
+        """Returns version of the stored index, which changes every time a new index is written."""
+        return self.get_index().version
+
     def load_embeddings(self):
         """Ensures embeddings are stored and loads them."""
-        if not os.path.exists(EMBEDDINGS_PATH):
+        if not os.path.exists(self.index_path):
             print(f"Missing embeddings. Please run store_embeddings.py first...")
         self.get_vectorizer()
         self.get_tfidf_matrix()
         self.get_metadata()
+        self.get_search_engine()
+
+    def is_loaded(self):
+        """Returns True, if the index is loaded into memory and ready for searching."""
+        return all(
+            part is not None
+            for part in (self._vectorizer, self._tfidf_matrix, self._metadata, self._search_engines.get("tfidf"))
+        )
 
     @staticmethod
-    def save_data(vectorizer, tfidf_matrix, metadata):
-        """Saves vectorizer, TF-IDF matrix, and metadata."""
-        os.makedirs(os.path.dirname(EMBEDDINGS_PATH), exist_ok=True)
+    def save_data(vectorizer, tfidf_matrix, metadata, index_path, version, extra_arrays=None, texts=None):
+        """Saves vectorizer, TF-IDF matrix, metadata, texts and arrays of optional engines to the index file."""
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        write_index(index_path, vectorizer, tfidf_matrix, metadata, version, extra_arrays, texts)
+
+
+def get_corpus(corpus):
+    """Returns configuration of the corpus, see CORPORA in src.config."""
+    if corpus not in CORPORA:
+        raise ValueError(f"Unknown corpus: {corpus}")
+    return CORPORA[corpus]
+
+
+def get_manifest_path(corpus):
+    return get_corpus(corpus)["index_dir"] / INDEX_MANIFEST_FILE_NAME
+
+
+def get_document_store(corpus=DEFAULT_CORPUS):
+    """Returns the document store of the corpus, compiling it first if its source file changed since it was compiled."""
+    with _document_stores_lock:
+        if corpus not in _document_stores:
+            source_path = get_corpus(corpus)["yaml_path"]
+            path = get_corpus(corpus)["index_dir"] / DOCUMENT_STORE_FILE_NAME
+            checksum = file_checksum(source_path)
+            try:
+                store = DocumentStore(path)
+            except (FileNotFoundError, ValueError):
+                # Missing, or written in an older format
+                store = None
+            if store is None or not store.is_compiled_from(checksum):
+                print(f"Compiling document store of corpus {corpus}...")
+                compile_document_store(source_path, path, checksum)
+                store = DocumentStore(path)
+            _document_stores[corpus] = store
+        return _document_stores[corpus]
+
+
+class IndexSnapshot:
+    """Index files of one build. A snapshot is never modified, a new build is loaded into a new snapshot.
+
+    Searches take the current snapshot once and use it until they finish, so swapping in a new
+    snapshot does not affect searches that are in progress.
+    """
+
+    def __init__(self, version, documents, chunks=None):
+        self.version = version
+        self.documents = documents
+        self.chunks = chunks
+
+    @staticmethod
+    def from_manifest(manifest, index_dir):
+        files = manifest["files"]
+        return IndexSnapshot(
+            manifest["version"],
+            EmbeddingManager(index_dir / files["documents"]),
+            EmbeddingManager(index_dir / files["chunks"]) if "chunks" in files else None,
+        )
+
+    @property
+    def size(self):
+        """Size of the index files in bytes, which is the memory they take once they are fully mapped."""
+        return sum(os.path.getsize(manager.index_path) for manager in (self.documents, self.chunks) if manager)
+
+    def get_embedding_manager(self, granularity="documents"):
+        """Returns manager of the chunk index for granularity "chunks", otherwise of the document index."""
+        if granularity != "chunks":
+            return self.documents
+        if self.chunks is None:
+            raise ValueError("Index build contains no chunk index, please run store_embeddings.py")
+        return self.chunks
+
+
+class IndexRegistry:
+    """Snapshots of the index builds in use, one per corpus.
+
+    Corpora are loaded on first use. When the index files of loaded corpora exceed the memory budget,
+    the least recently used ones are unloaded, only searches that are still in progress keep their
+    snapshot until they finish.
+
+    Snapshots of loaded corpora are returned without waiting for loads. Corpora and new builds are loaded under
+    a lock of their corpus, so loading one corpus never blocks searches, and the registry lock is held only
+    to mark a corpus as recently used, and while a loaded snapshot is swapped in and others are unloaded.
+    """
 
-        save_npz(EMBEDDINGS_PATH, tfidf_matrix)
-        joblib.dump(vectorizer, VECTORIZER_PATH)
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self._snapshots = OrderedDict()
+        self._lock = Lock()
+        self._load_locks = {}
 
-        with open(METADATA_PATH, "w") as f:
-            json.dump(metadata, f)
+    def get(self, corpus):
+        """Returns the snapshot of the corpus, loading it from its manifest if the corpus is not loaded."""
+        snapshot = self._snapshots.get(corpus)
+        if snapshot is not None:
+            self._touch(corpus)
+            return snapshot
 
+        with self._load_lock(corpus):
+            # Another thread may have loaded the corpus while this one waited for the lock
+            snapshot = self._snapshots.get(corpus)
+            if snapshot is None:
+                manifest = read_manifest(get_manifest_path(corpus))
+                snapshot = IndexSnapshot.from_manifest(manifest, get_corpus(corpus)["index_dir"])
+                self._put(corpus, snapshot)
+            return snapshot
 
-def preprocess(text):
+    def reload(self, corpus):
+        """Loads the build from the manifest of a loaded corpus and swaps it in, if it differs from the one in use.
+
+        The new build is loaded before it is swapped in, so searches never wait for it. Returns True if
+        a new build was swapped in.
+        """
+        with self._load_lock(corpus):
+            current = self._snapshots.get(corpus)
+            manifest = read_manifest(get_manifest_path(corpus))
+            if current is None or current.version == manifest["version"]:
+                return False
+
+            snapshot = IndexSnapshot.from_manifest(manifest, get_corpus(corpus)["index_dir"])
+            snapshot.documents.load_embeddings()
+            # Assignment of the reference is atomic, searches see either the old or the new snapshot
+            self._put(corpus, snapshot)
+            return True
+
+    def loaded(self):
+        """Returns names of the loaded corpora, least recently used first."""
+        with self._lock:
+            return list(self._snapshots)
+
+    def _load_lock(self, corpus):
+        with self._lock:
+            return self._load_locks.setdefault(corpus, Lock())
+
+    def _touch(self, corpus):
+        # Marks the corpus as recently used, an unloaded corpus is skipped. The lock is only held while it is
+        # moved, as moving it while the budget of loaded snapshots is summed would break that iteration.
+        with self._lock:
+            if corpus in self._snapshots:
+                self._snapshots.move_to_end(corpus)
+
+    def _put(self, corpus, snapshot):
+        with self._lock:
+            self._snapshots[corpus] = snapshot
+            self._snapshots.move_to_end(corpus)
+
+            # The corpus that was just put is never unloaded, even if it alone exceeds the budget
+            while len(self._snapshots) > 1 and \
+                    sum(s.size for s in list(self._snapshots.values())) > self.memory_budget:
+                unloaded, _ = self._snapshots.popitem(last=False)
+                print(f"Unloaded index of corpus {unloaded}")
+
+
+index_registry = IndexRegistry(INDEX_MEMORY_BUDGET_MB * 2 ** 20)
+
+
+def get_snapshot(corpus=DEFAULT_CORPUS):
+    """Returns the snapshot of the index build of the corpus in use, loading it on first call."""
+    return index_registry.get(corpus)
+
+
+def get_embedding_manager(granularity="documents", corpus=DEFAULT_CORPUS):
+    """Returns manager of the given index of the current snapshot of the corpus."""
+    return get_snapshot(corpus).get_embedding_manager(granularity)
+
+
+def reload_index(corpus=DEFAULT_CORPUS):
+    """Swaps in the index build the manifest of the corpus points to, see IndexRegistry.reload."""
+    return index_registry.reload(corpus)
+
+
+def watch_index(interval):
+    """Checks manifests of loaded corpora for new index builds every interval seconds and loads them. Runs forever."""
+    last_modified = {}
+    while True:
+        for corpus in index_registry.loaded():
+            try:
+                modified = os.path.getmtime(get_manifest_path(corpus))
+                if last_modified.get(corpus, modified) != modified and reload_index(corpus):
+                    print(f"Loaded index build {get_snapshot(corpus).version} of corpus {corpus}")
+                last_modified[corpus] = modified
+            except Exception as e:
+                print(f"Error while reloading the index of corpus {corpus}: {e}")
+        time.sleep(interval)
+
+
+def preprocess_key(text, corpus):
+    """Returns the key of the text in the preprocess cache.
+
+    Lemmas of the dictionary lemmatizer depend on the word form table of the index, so their keys include
+    the version of the index, and lemmas made with the table of a previous build are not served.
+    """
+    if QUERY_LEMMATIZER == "dictionary":
+        return f"{QUERY_LEMMATIZER}|{corpus}|{get_snapshot(corpus).version}|{normalize_query(text)}"
+    return f"{QUERY_LEMMATIZER}|{corpus}|{normalize_query(text)}"
+
+
+def preprocess(text, use_cache=True, corpus=DEFAULT_CORPUS):
     """Preprocesses text using lemmatization and stopword removal."""
-    doc = nlp(text)
-    return ' '.join(
-        token.words[0].lemma.lower()
-        for sentence in doc.sentences
-        for token in sentence.tokens
-        if (token.words[0].lemma.isalpha() or token.words[0].lemma.isdigit())
-        and token.words[0].lemma.lower() not in stop_words
-    )
+    if use_cache:
+        key = preprocess_key(text, corpus)
+        cached = preprocess_cache.get(key)
+        if cached is not None:
+            return cached
+
+    preprocessed = lemmatize_many([text], corpus=corpus)[0]
+
+    if use_cache:
+        preprocess_cache.put(key, preprocessed)
+    return preprocessed
+
+
+def preprocess_many(texts, use_cache=True, corpus=DEFAULT_CORPUS):
+    """Preprocesses multiple texts with a single pass of the classla pipeline."""
+    if not use_cache:
+        return lemmatize_many(texts, corpus=corpus)
+
+    keys = [preprocess_key(text, corpus) for text in texts]
+    preprocessed = [preprocess_cache.get(key) for key in keys]
+
+    # Only texts that are not cached are lemmatized
+    missing = [i for i, cached in enumerate(preprocessed) if cached is None]
+    for i, lemmas in zip(missing, lemmatize_many([texts[i] for i in missing], corpus=corpus)):
+        preprocessed[i] = lemmas
+        preprocess_cache.put(keys[i], lemmas)
+
+    return preprocessed
+
+
+def lemmatize_many(texts, lemmatizer=QUERY_LEMMATIZER, corpus=DEFAULT_CORPUS):
+    """Lemmatizes texts with the given lemmatizer, "dictionary" or "classla".
+
+    The dictionary lemmatizer uses the word form table of the current index of the corpus and lemmatizes
+    only unknown words with classla. Without a table in the index, texts are lemmatized with classla.
+    """
+    if lemmatizer == "dictionary":
+        dictionary = get_embedding_manager(corpus=corpus).get_lemma_dictionary()
+        if dictionary is not None:
+            return dictionary.lemmatize_many(texts, classla_lemmatize_many)
+        if corpus not in _dictionary_fallbacks:
+            _dictionary_fallbacks.add(corpus)
+            print(f"Index of corpus {corpus} contains no word form table, queries are lemmatized with classla")
+    elif lemmatizer != "classla":
+        raise ValueError(f"Unknown lemmatizer: {lemmatizer}")
+    return classla_lemmatize_many(texts)
+
+
+def classla_lemmatize_many(texts):
+    """Lemmatizes texts with the lemmatization service, or with the shared pipeline if the service is disabled."""
+    service = get_lemmatization_service()
+    if service is not None:
+        return service.lemmatize_many(texts)
+    return lemmatize_texts(get_nlp(), texts)
+
+
+def warm_up():
+    """Loads the classla pipeline(s), search index and document store, so the first request does not pay for it."""
+    service = get_lemmatization_service()
+    if service is not None:
+        service.wait_ready()
+    else:
+        get_nlp()
+    get_embedding_manager().load_embeddings()
+    get_document_store()
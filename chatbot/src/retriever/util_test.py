@@ -0,0 +1,69 @@
+import sys
+import time
+from threading import Thread
+
+from src.retriever.util import IndexRegistry
+
+
+class FakeSnapshot:
+    def __init__(self, version):
+        self.version = version
+
+    @property
+    def size(self):
+        # Gives way to other threads while sizes are summed, as reading sizes of index files would
+        time.sleep(0)
+        return 1
+
+
+def test_concurrent_gets_and_puts():
+    # Switching threads often makes a get move a corpus while a put is summing sizes of snapshots
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    registry = IndexRegistry(memory_budget=10 ** 9)
+    corpora = [f"corpus_{i}" for i in range(50)]
+    for corpus in corpora:
+        registry._put(corpus, FakeSnapshot("v1"))
+
+    errors = []
+
+    def run(function, repeat):
+        try:
+            for i in range(repeat):
+                function(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=run, args=(lambda i: registry.get(corpora[i % len(corpora)]), 20_000))
+               for _ in range(4)]
+    threads += [Thread(target=run, args=(lambda i: registry._put(corpora[i % len(corpora)], FakeSnapshot(i)), 1_000))
+                for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert errors == []
+    assert sorted(registry.loaded()) == sorted(corpora)
+
+
+def test_get_marks_corpus_as_recently_used():
+    registry = IndexRegistry(memory_budget=10 ** 9)
+    for corpus in ("a", "b", "c"):
+        registry._put(corpus, FakeSnapshot("v1"))
+
+    registry.get("a")
+    assert registry.loaded() == ["b", "c", "a"]
+
+
+def test_least_recently_used_corpus_is_unloaded_over_budget():
+    registry = IndexRegistry(memory_budget=2)
+    for corpus in ("a", "b"):
+        registry._put(corpus, FakeSnapshot("v1"))
+    registry.get("a")
+
+    registry._put("c", FakeSnapshot("v1"))
+    assert registry.loaded() == ["a", "c"]
@@ -26,7 +26,11 @@ if __name__ == '__main__':
             "answer": None,
             "top_3": [],
             "relevant_part_texts": [],
-            "valid_rag_answer": None
+            "valid_rag_answer": None,
+            "speculative_query": None,
+            "speculative_docs": None,
+            "retrieved_docs": None,
+            "cached_answer": None
         }
 
         config = {"configurable": {"thread_id": "1"}}